@@ -0,0 +1,282 @@
+import os
+import sys
+import io
+import gc
+import json
+import time
+import gzip
+import shutil
+import hashlib
+import logging
+import zipfile
+import argparse
+import resource
+import tempfile
+import tracemalloc
+
+import requests
+from requests.adapters import BaseAdapter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import block_ads_sync as bas
+
+logger = logging.getLogger("bench_compile")
+
+# ---------------------------------------------------------------------------
+# Fixtures: recorded upstream responses or synthetic ones, replayed offline
+# ---------------------------------------------------------------------------
+INDEX_FILE = "index.json"
+
+def fixture_urls() -> list[str]:
+    urls = []
+    for url in bas.BLOCKLIST_URLS.values(): urls.extend([url] if isinstance(url, str) else url)
+    urls.extend(source["url"] for source in bas.TOP_LISTS)
+    urls.append(bas.SPAM_TLD_URL)
+    return urls
+
+def _fixture_name(url: str) -> str:
+    return hashlib.sha256(url.encode("utf-8")).hexdigest()[:16] + "-" + os.path.basename(url.split("?")[0])
+
+class ReplayAdapter(BaseAdapter):
+    # Serves every request from a fixture directory so the pipeline runs without the network.
+    def __init__(self, root: str):
+        super().__init__()
+        self.root = root
+        with open(os.path.join(root, INDEX_FILE), encoding="utf-8") as f:
+            self.index = json.load(f)
+
+    def send(self, request, **kwargs):
+        resp = requests.Response()
+        resp.request, resp.url = request, request.url
+        entry = self.index.get(request.url)
+        if entry is None:
+            resp.status_code, resp.raw = 404, io.BytesIO(b"")
+            return resp
+        resp.status_code = 200
+        resp.headers.update(entry.get("headers", {}))
+        resp.raw = open(os.path.join(self.root, entry["file"]), "rb")
+        return resp
+
+    def close(self):
+        pass
+
+def replay_session(root: str) -> requests.Session:
+    session = requests.Session()
+    adapter = ReplayAdapter(root)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+def record_fixtures(root: str) -> None:
+    os.makedirs(root, exist_ok=True)
+    index = {}
+    with requests.Session() as session:
+        for url in fixture_urls():
+            name = _fixture_name(url)
+            try:
+                with session.get(url, stream=True, timeout=(10, 300), headers={"User-Agent": "Mozilla/5.0"}) as r:
+                    r.raise_for_status()
+                    # Stored decoded: replay hands the file to requests as-is, and nothing would undo a transport gzip.
+                    with open(os.path.join(root, name), "wb") as f:
+                        for chunk in r.raw.stream(1 << 20, decode_content=True): f.write(chunk)
+                    headers = {k: v for k, v in r.headers.items() if k.lower() == "content-type"}
+            except requests.RequestException as e:
+                logger.warning(f"Could not record {url}: {e}")
+                continue
+            index[url] = {"file": name, "headers": headers}
+            logger.info(f"Recorded {url} -> {name} ({os.path.getsize(os.path.join(root, name)):,} bytes)")
+    with open(os.path.join(root, INDEX_FILE), "w", encoding="utf-8") as f:
+        json.dump(index, f, indent=2)
+
+# --- synthetic generator ------------------------------------------------------
+TLDS = ["com", "net", "org", "io", "xyz", "top", "info", "de", "ru", "co.uk"]
+SUBS = ["ads", "cdn", "track", "px", "stats", "sync", "img", "api", "m", "www"]
+
+def _registrable(j: int) -> str:
+    return f"site{j:x}.{TLDS[j % len(TLDS)]}"
+
+def _domain(i: int, registrables: int) -> str:
+    base = _registrable(i % registrables)
+    depth = (i // registrables) % 3
+    return base if depth == 0 else ".".join([f"{SUBS[(i + k) % len(SUBS)]}{i // registrables}" for k in range(depth)] + [base])
+
+def _blocklist_line(domain: str, fmt: str) -> str:
+    if fmt == "abp": return f"||{domain}^\n"
+    if fmt == "hosts": return f"0.0.0.0 {domain}\n"
+    return f"{domain}\n"
+
+def generate_fixtures(root: str, domains: int, top_size: int, overlap: float = 0.3) -> None:
+    os.makedirs(root, exist_ok=True)
+    index = {}
+    registrables = max(1, domains // 3)
+    block_urls = [u for u in fixture_urls() if u not in {t["url"] for t in bas.TOP_LISTS} and u != bas.SPAM_TLD_URL]
+    per_source = max(1, domains // len(block_urls))
+    step = max(1, int(per_source * (1 - overlap)))
+
+    for k, url in enumerate(block_urls):
+        fmt = "abp" if "abp" in url else "hosts" if "hosts" in url else "plain"
+        name = _fixture_name(url)
+        with open(os.path.join(root, name), "w", encoding="utf-8") as f:
+            f.write(f"# synthetic {fmt} fixture for {url}\n")
+            for i in range(k * step, k * step + per_source): f.write(_blocklist_line(_domain(i, registrables), fmt))
+        index[url] = {"file": name, "headers": {"Content-Type": "text/plain"}}
+
+    for k, source in enumerate(bas.TOP_LISTS):
+        url, col, skip, comp = source["url"], source["col"], source["skip_header"], source["compression"]
+        name = _fixture_name(url)
+        path = os.path.join(root, name)
+        # Every other registrable domain is "popular", each top list seeing a shifted window of them.
+        def rows():
+            if skip: yield "header\n"
+            for r in range(top_size):
+                j = (2 * (r + k * top_size // 4)) % max(1, registrables)
+                yield ",".join(["1"] * col + [_registrable(j), str(r + 1)]) + "\n"
+        if comp == "zip":
+            with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as z, z.open("top.csv", "w") as member:
+                for row in rows(): member.write(row.encode("utf-8"))
+        elif comp == "gzip":
+            with gzip.open(path, "wt", encoding="utf-8") as f:
+                for row in rows(): f.write(row)
+        else:
+            with open(path, "w", encoding="utf-8") as f:
+                for row in rows(): f.write(row)
+        index[url] = {"file": name, "headers": {}}
+
+    name = _fixture_name(bas.SPAM_TLD_URL)
+    with open(os.path.join(root, name), "w", encoding="utf-8") as f:
+        f.write("top\nxyz\n")
+    index[bas.SPAM_TLD_URL] = {"file": name, "headers": {}}
+
+    with open(os.path.join(root, INDEX_FILE), "w", encoding="utf-8") as f:
+        json.dump(index, f, indent=2)
+
+# ---------------------------------------------------------------------------
+# Stage measurement
+# ---------------------------------------------------------------------------
+class StageTimer:
+    def __init__(self, trace_memory: bool):
+        self.trace_memory = trace_memory
+        self.results: list[dict] = []
+
+    def run(self, stage: str, fn, count=None):
+        gc.collect()
+        blocks_before = sys.getallocatedblocks()
+        if self.trace_memory: tracemalloc.start()
+        start = time.perf_counter()
+        value = fn()
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] if self.trace_memory else None
+        if self.trace_memory: tracemalloc.stop()
+        items = count(value) if count else len(value)
+        result = {
+            "stage": stage,
+            "items": items,
+            "seconds": round(elapsed, 4),
+            "per_sec": round(items / elapsed, 1) if elapsed else None,
+            "peak_mb": round(peak / 1e6, 2) if peak is not None else None,
+            "net_blocks": sys.getallocatedblocks() - blocks_before,
+            "maxrss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        }
+        self.results.append(result)
+        logger.info(f"{stage}: {items:,} items in {elapsed:.3f}s")
+        return value
+
+def run_pipeline(fixtures: str, trace_memory: bool, workdir: str) -> list[dict]:
+    session = replay_session(fixtures)
+    timer = StageTimer(trace_memory)
+
+    checker = bas.RelevanceChecker(session, data_dir=os.path.join(workdir, "relevance"))
+    timer.run("relevance_build", lambda: checker.build_dataset(max_workers=bas.Config.MAX_WORKERS) or checker.index)
+
+    def parse_all():
+        table = bas.DomainTable(bas.BLOCKLIST_URLS)
+        for name, url in bas.BLOCKLIST_URLS.items(): table.add(name, bas.fetch_url(session, name, url)[1])
+        return table
+    table = timer.run("parse", parse_all)
+
+    unique = list(table.masks)
+    n = len(unique)
+    timer.run("is_relevant", lambda: [d for d in unique if checker.is_relevant(d)], count=lambda _: n)
+    unique.clear()
+    timer.run(f"filter x{checker.processes}", lambda: table.filter_relevance(checker, bas.RELEVANCE_EXEMPT), count=lambda _: n)
+
+    timer.run("optimize_domains", lambda: bas.optimize_domains(table.masks), count=lambda _: len(table))
+    compiled = timer.run("build_policy_sets", lambda: bas.build_policy_sets(bas.POLICIES, table), count=lambda _: len(table))
+    formats = [fmt for fmt in bas.ARTIFACTS if fmt != "zstd" or bas.zstandard]
+    timer.run("write_artifacts", lambda: bas.write_artifacts(compiled, formats, workdir), count=lambda n: n)
+    checker.close()
+    checker.index.close()
+    return timer.results
+
+def compare(results: list[dict], baseline: list[dict], tolerance: float) -> list[str]:
+    base = {r["stage"]: r for r in baseline}
+    regressions = []
+    for r in results:
+        b = base.get(r["stage"])
+        if not b: continue
+        if b.get("per_sec") and r["per_sec"] and r["per_sec"] < b["per_sec"] * (1 - tolerance):
+            regressions.append(f"{r['stage']}: throughput {r['per_sec']:,.0f}/s vs baseline {b['per_sec']:,.0f}/s")
+        if b.get("peak_mb") and r["peak_mb"] and r["peak_mb"] > b["peak_mb"] * (1 + tolerance):
+            regressions.append(f"{r['stage']}: peak memory {r['peak_mb']:.1f} MB vs baseline {b['peak_mb']:.1f} MB")
+    return regressions
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the CPU-bound blocklist compilation stages against recorded or synthetic fixtures.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    rec = sub.add_parser("record", help="download the real BLOCKLIST_URLS/TOP_LISTS responses into a fixture directory")
+    rec.add_argument("fixtures")
+    run = sub.add_parser("run", help="run the benchmark")
+    src = run.add_mutually_exclusive_group(required=True)
+    src.add_argument("--fixtures", help="replay a recorded fixture directory")
+    src.add_argument("--synthetic", type=int, metavar="N", help="generate N blocklist domains (scales to 10M)")
+    run.add_argument("--top-size", type=int, default=None, help="rows per synthetic top list (default: min(N, 1M))")
+    run.add_argument("--no-trace-memory", action="store_true", help="skip tracemalloc (faster, no peak_mb)")
+    run.add_argument("--baseline", help="compare against this results file and exit non-zero on regression")
+    run.add_argument("--tolerance", type=float, default=0.15)
+    run.add_argument("--save", help="write the results to this file (e.g. to become the new baseline)")
+    args = parser.parse_args()
+
+    logging.getLogger(bas.__name__).setLevel(logging.WARNING)
+    logger.setLevel(logging.INFO)
+
+    if args.command == "record":
+        record_fixtures(args.fixtures)
+        return
+
+    workdir = tempfile.mkdtemp(prefix="bench-compile-")
+    try:
+        fixtures = args.fixtures
+        if fixtures is None:
+            fixtures = os.path.join(workdir, "fixtures")
+            logger.info(f"Generating synthetic fixtures ({args.synthetic:,} domains)...")
+            generate_fixtures(fixtures, args.synthetic, args.top_size or min(args.synthetic, 1_000_000))
+        results = run_pipeline(fixtures, not args.no_trace_memory, workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"\n{'stage':<18} {'items':>12} {'seconds':>9} {'items/s':>12} {'peak MB':>9} {'net blocks':>11} {'maxrss MB':>10}")
+    for r in results:
+        peak = f"{r['peak_mb']:.1f}" if r["peak_mb"] is not None else "-"
+        print(f"{r['stage']:<18} {r['items']:>12,} {r['seconds']:>9.3f} {r['per_sec'] or 0:>12,.0f} {peak:>9} {r['net_blocks']:>11,} {r['maxrss_mb']:>10.1f}")
+
+    report = {"source": args.fixtures or f"synthetic:{args.synthetic}", "trace_memory": not args.no_trace_memory, "python": sys.version.split()[0], "stages": results}
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("source") != report["source"]:
+            logger.warning(f"Baseline was recorded against {baseline.get('source')}, not {report['source']}")
+        if baseline.get("trace_memory") != report["trace_memory"]:
+            logger.warning("Baseline and this run differ in tracemalloc use; throughput is not comparable")
+        regressions = compare(results, baseline["stages"], args.tolerance)
+        for line in regressions: logger.error(f"Regression: {line}")
+        if regressions: sys.exit(1)
+        logger.info(f"No regressions beyond {args.tolerance:.0%} against {args.baseline}")
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s", datefmt="%H:%M:%S")
+    main()
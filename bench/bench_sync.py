@@ -0,0 +1,117 @@
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import block_ads_sync as bas
+from fake_gateway import GatewayState, start_server
+
+# ---------------------------------------------------------------------------
+# End-to-end sync benchmark against the local Gateway stand-in
+# ---------------------------------------------------------------------------
+TLDS = ["com", "net", "org", "io", "xyz", "top", "info", "biz"]
+
+class SyntheticSources:
+    def __init__(self, state: GatewayState, base_url: str, sizes: dict[str, int], seed: int = 1):
+        self.state, self.base_url = state, base_url
+        self.rng = random.Random(seed)
+        self._next = 0
+        self.domains = {name: [self._domain() for _ in range(size)] for name, size in sizes.items()}
+        self.publish()
+
+    def _domain(self) -> str:
+        self._next += 1
+        return f"ad{self._next:07d}.{self.rng.choice(['cdn', 'track', 'px', 'sync', 'stats'])}.{self.rng.choice(TLDS)}"
+
+    def slug(self, name: str) -> str:
+        return name.lower().replace(" ", "-")
+
+    def publish(self) -> None:
+        for name, domains in self.domains.items():
+            self.state.sources[f"{self.slug(name)}.txt"] = ("\n".join(domains) + "\n").encode("utf-8")
+        self.state.sources["spam-tlds.txt"] = b"top\nxyz\nbiz\n"
+
+    def urls(self) -> dict[str, str]:
+        return {name: f"{self.base_url}/sources/{self.slug(name)}.txt" for name in self.domains}
+
+    def churn(self, share: float) -> None:
+        for domains in self.domains.values():
+            for i in self.rng.sample(range(len(domains)), max(1, int(len(domains) * share))):
+                domains[i] = self._domain()
+        self.publish()
+
+    def grow(self, share: float) -> None:
+        for domains in self.domains.values():
+            domains.extend(self._domain() for _ in range(int(len(domains) * share)))
+        self.publish()
+
+def run_scenario(state: GatewayState, label: str) -> dict:
+    state.reset_stats()
+    start = time.perf_counter()
+    bas.main([])
+    elapsed = time.perf_counter() - start
+    stats = state.snapshot_stats()
+    result = {"scenario": label, "wall_s": round(elapsed, 3), "api_calls": sum(stats["calls"].values()), **stats}
+    logging.getLogger(__name__).info(f"[bench] {label}: {result['api_calls']} calls, {stats['bytes_in']:,} bytes sent, {elapsed:.2f}s")
+    return result
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark block_ads_sync.main() against a local Gateway API stand-in.")
+    parser.add_argument("--scale", type=int, default=20_000, help="domains per synthetic source")
+    parser.add_argument("--churn", type=float, default=0.01, help="share of each source replaced in the churn scenario")
+    parser.add_argument("--grow", type=float, default=0.3, help="share each source grows by in the list-count scenario")
+    parser.add_argument("--rate-limit", type=float, default=1000.0, help="override Config.API_RATE_LIMIT (requests/second)")
+    parser.add_argument("--throttle", type=float, default=0.0, help="429 probability for an extra throttled churn scenario")
+    parser.add_argument("--accounts", type=int, default=1, help="fan the sync out to this many fake accounts via ACCOUNTS_JSON")
+    parser.add_argument("--shard-lists", type=int, default=0, help="override Config.RULE_SHARD_LISTS (lists per rule shard)")
+    parser.add_argument("--json", metavar="PATH", help="also write the results as JSON")
+    args = parser.parse_args()
+
+    state = GatewayState(retry_after=0.2)
+    server = start_server(state)
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    workdir = tempfile.mkdtemp(prefix="bench-sync-")
+    os.chdir(workdir)
+
+    sources = SyntheticSources(state, base_url, {name: args.scale for name in bas.BLOCKLIST_URLS})
+    bas.BLOCKLIST_URLS = sources.urls()
+    bas.SPAM_TLD_URL = f"{base_url}/sources/spam-tlds.txt"
+    bas.Config.API_BASE_URL = f"{base_url}/client/v4"
+    bas.Config.API_TOKEN, bas.Config.ACCOUNT_ID, bas.Config.PRIMARY_EMAIL = "bench-token", "bench", "bench@example.com"
+    bas.Config.CACHE_DIR = os.path.join(workdir, ".cache")
+    bas.Config.ENABLE_RELEVANCE_FILTER = False
+    bas.Config.API_RATE_LIMIT = args.rate_limit
+    bas.Config.API_BURST = max(bas.Config.API_BURST, int(args.rate_limit))
+    bas.Config.RULE_SHARD_LISTS = args.shard_lists
+    if args.accounts > 1:
+        bas.Config.ACCOUNTS_JSON = json.dumps([{"name": f"bench-{i}", "account_id": f"bench-{i}", "api_token": "bench-token"} for i in range(args.accounts)])
+
+    results = [run_scenario(state, "cold"), run_scenario(state, "no-change")]
+    sources.churn(args.churn)
+    results.append(run_scenario(state, f"churn {args.churn:.0%}"))
+    sources.grow(args.grow)
+    results.append(run_scenario(state, f"grow {args.grow:.0%} (list count change)"))
+    if args.throttle:
+        state.error_rate_429 = args.throttle
+        sources.churn(args.churn)
+        results.append(run_scenario(state, f"churn {args.churn:.0%} with {args.throttle:.0%} 429s"))
+        state.error_rate_429 = 0.0
+    server.shutdown()
+
+    print(f"\n{'scenario':<34} {'calls':>6} {'GET':>5} {'POST':>5} {'PUT':>5} {'PATCH':>6} {'DELETE':>7} {'bytes sent':>12} {'wall s':>8}")
+    for r in results:
+        by_verb = {verb: sum(n for k, n in r["calls"].items() if k.startswith(verb + " ")) for verb in ("GET", "POST", "PUT", "PATCH", "DELETE")}
+        print(f"{r['scenario']:<34} {r['api_calls']:>6} {by_verb['GET']:>5} {by_verb['POST']:>5} {by_verb['PUT']:>5} {by_verb['PATCH']:>6} {by_verb['DELETE']:>7} {r['bytes_in']:>12,} {r['wall_s']:>8.2f}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+import re
+import json
+import time
+import random
+import hashlib
+import argparse
+import itertools
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+# ---------------------------------------------------------------------------
+# Local stand-in for the Cloudflare Gateway lists/rules API
+# ---------------------------------------------------------------------------
+MAX_LIST_ITEMS = 1000
+MAX_LISTS      = 300
+LIST_REF       = re.compile(r"\$([0-9A-Za-z-]+)")
+ROUTE          = re.compile(r"^/client/v4/accounts/(?P<account>[^/]+)/gateway/(?P<kind>lists|rules)(?:/(?P<id>[^/]+))?$")
+
+class GatewayState:
+    def __init__(self, error_rate_429: float = 0.0, error_rate_5xx: float = 0.0, retry_after: float = 1.0, seed: int = 0):
+        self.lock = threading.RLock()
+        self.tenants: dict[str, dict] = {}
+        self.sources: dict[str, bytes] = {}
+        self.error_rate_429, self.error_rate_5xx, self.retry_after = error_rate_429, error_rate_5xx, retry_after
+        self.rng = random.Random(seed)
+        self._ids = itertools.count(1)
+        self.reset_stats()
+
+    def reset_stats(self) -> None:
+        with self.lock:
+            self.calls: dict[str, int] = {}
+            self.account_calls: dict[str, int] = {}
+            self.status: dict[int, int] = {}
+            self.bytes_in = 0
+            self.bytes_out = 0
+
+    def new_id(self) -> str:
+        return f"{next(self._ids):08x}-0000-4000-8000-000000000000"
+
+    def tenant(self, account: str) -> dict:
+        # Each account gets its own lists, rules and list quota.
+        return self.tenants.setdefault(account, {"lists": {}, "rules": {}})
+
+    @property
+    def lists(self) -> dict[str, dict]:
+        return {lid: l for t in self.tenants.values() for lid, l in t["lists"].items()}
+
+    @property
+    def rules(self) -> dict[str, dict]:
+        return {rid: r for t in self.tenants.values() for rid, r in t["rules"].items()}
+
+    def snapshot_stats(self) -> dict:
+        with self.lock:
+            return {"calls": dict(self.calls), "accounts": dict(self.account_calls), "status": dict(self.status), "bytes_in": self.bytes_in, "bytes_out": self.bytes_out, "lists": len(self.lists), "rules": len(self.rules)}
+
+def _now() -> str:
+    now = time.time_ns() // 1000
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(now // 1_000_000)) + f".{now % 1_000_000:06d}Z"
+
+def _public_list(lst: dict) -> dict:
+    return {k: v for k, v in lst.items() if k != "items"} | {"count": len(lst["items"])}
+
+class GatewayHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    state: GatewayState = None
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status: int, payload=None, headers: dict = None, raw: bytes = None) -> None:
+        body = raw if raw is not None else json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json" if raw is None else "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in (headers or {}).items(): self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+        with self.state.lock:
+            self.state.bytes_out += len(body)
+            self.state.status[status] = self.state.status.get(status, 0) + 1
+
+    def _ok(self, result, result_info: dict = None) -> None:
+        payload = {"success": True, "errors": [], "messages": [], "result": result}
+        if result_info: payload["result_info"] = result_info
+        self._send(200, payload)
+
+    def _error(self, status: int, code: int, message: str, headers: dict = None) -> None:
+        self._send(status, {"success": False, "errors": [{"code": code, "message": message}], "messages": [], "result": None}, headers)
+
+    def _handle(self, method: str) -> None:
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+        url = urlsplit(self.path)
+
+        if url.path.startswith("/sources/"):
+            return self._serve_source(url.path[len("/sources/"):])
+
+        match = ROUTE.match(url.path)
+        st = self.state
+        with st.lock:
+            st.bytes_in += len(raw) + len(self.path) + sum(len(k) + len(v) + 4 for k, v in self.headers.items())
+            key = f"{method} {match.group('kind') if match else '?'}"
+            st.calls[key] = st.calls.get(key, 0) + 1
+            if match: st.account_calls[match.group("account")] = st.account_calls.get(match.group("account"), 0) + 1
+            roll = st.rng.random()
+        if not match: return self._error(404, 7000, "No route for that URI")
+        if roll < st.error_rate_429:
+            return self._error(429, 10000, "Rate limited", {"Retry-After": f"{st.retry_after:g}"})
+        if roll < st.error_rate_429 + st.error_rate_5xx:
+            return self._error(503, 10001, "Service unavailable")
+
+        body = json.loads(raw) if raw else {}
+        kind, oid = match.group("kind"), match.group("id")
+        with st.lock:
+            tenant = st.tenant(match.group("account"))
+            self.lists, self.rules = tenant["lists"], tenant["rules"]
+            handler = getattr(self, f"_{kind}_{method.lower()}", None)
+            if handler is None: return self._error(405, 10405, "Method not allowed")
+            return handler(oid, body, parse_qs(url.query))
+
+    def _serve_source(self, name: str) -> None:
+        data = self.state.sources.get(name)
+        if data is None: return self._error(404, 404, "Unknown source")
+        etag = f'"{hashlib.sha256(data).hexdigest()[:16]}"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self._send(200, raw=data, headers={"ETag": etag})
+
+    def _paginate(self, items: list[dict], query: dict) -> None:
+        page = int(query.get("page", ["1"])[0])
+        per_page = int(query.get("per_page", ["100"])[0])
+        total_pages = max(1, -(-len(items) // per_page))
+        chunk = items[(page - 1) * per_page : page * per_page]
+        self._ok(chunk, {"page": page, "per_page": per_page, "count": len(chunk), "total_count": len(items), "total_pages": total_pages})
+
+    # --- lists ---------------------------------------------------------------
+    def _lists_get(self, lid, body, query):
+        if lid:
+            lst = self.lists.get(lid)
+            return self._ok(_public_list(lst)) if lst else self._error(404, 7003, "List not found")
+        self._paginate([_public_list(l) for l in self.lists.values()], query)
+
+    def _lists_post(self, lid, body, query):
+        items = [i["value"] for i in body.get("items") or []]
+        if len(self.lists) >= MAX_LISTS: return self._error(400, 2100, f"Account has reached the {MAX_LISTS} list limit")
+        if len(items) > MAX_LIST_ITEMS: return self._error(400, 2101, f"Lists are limited to {MAX_LIST_ITEMS} items")
+        now = _now()
+        lst = {"id": self.state.new_id(), "name": body["name"], "type": body.get("type", "DOMAIN"), "description": body.get("description", ""), "items": items, "created_at": now, "updated_at": now}
+        self.lists[lst["id"]] = lst
+        self._ok(_public_list(lst) | {"items": [{"value": v} for v in items]})
+
+    def _lists_put(self, lid, body, query):
+        lst = self.lists.get(lid)
+        if not lst: return self._error(404, 7003, "List not found")
+        if "items" in body:
+            items = [i["value"] for i in body["items"] or []]
+            if len(items) > MAX_LIST_ITEMS: return self._error(400, 2101, f"Lists are limited to {MAX_LIST_ITEMS} items")
+            lst["items"] = items
+        lst["name"] = body.get("name", lst["name"])
+        lst["description"] = body.get("description", lst["description"])
+        lst["updated_at"] = _now()
+        self._ok(_public_list(lst))
+
+    def _lists_patch(self, lid, body, query):
+        lst = self.lists.get(lid)
+        if not lst: return self._error(404, 7003, "List not found")
+        remove = set(body.get("remove") or [])
+        items = [v for v in lst["items"] if v not in remove]
+        present = set(items)
+        items.extend(v for v in (i["value"] for i in body.get("append") or []) if v not in present)
+        if len(items) > MAX_LIST_ITEMS: return self._error(400, 2101, f"Lists are limited to {MAX_LIST_ITEMS} items")
+        lst["items"] = items
+        lst["updated_at"] = _now()
+        self._ok(_public_list(lst))
+
+    def _lists_delete(self, lid, body, query):
+        if lid not in self.lists: return self._error(404, 7003, "List not found")
+        if any(lid in LIST_REF.findall(r.get("traffic", "")) for r in self.rules.values()): return self._error(400, 2102, "List is referenced by a rule and cannot be deleted")
+        del self.lists[lid]
+        self._ok({})
+
+    # --- rules ---------------------------------------------------------------
+    def _check_refs(self, body: dict) -> str | None:
+        missing = [lid for lid in LIST_REF.findall(body.get("traffic", "")) if lid not in self.lists]
+        return f"Rule references unknown lists: {', '.join(missing)}" if missing else None
+
+    def _rules_get(self, rid, body, query):
+        if rid:
+            rule = self.rules.get(rid)
+            return self._ok(rule) if rule else self._error(404, 7003, "Rule not found")
+        self._paginate(list(self.rules.values()), query)
+
+    def _rules_post(self, rid, body, query):
+        if (err := self._check_refs(body)): return self._error(400, 2103, err)
+        # Like the real API, a rule created without a precedence goes after every existing one.
+        precedence = body.get("precedence", max((r.get("precedence") or 0 for r in self.rules.values()), default=0) + 1000)
+        rule = {"identity": "", **body, "id": self.state.new_id(), "precedence": precedence, "created_at": _now(), "updated_at": _now()}
+        self.rules[rule["id"]] = rule
+        self._ok(rule)
+
+    def _rules_put(self, rid, body, query):
+        if rid not in self.rules: return self._error(404, 7003, "Rule not found")
+        if (err := self._check_refs(body)): return self._error(400, 2103, err)
+        old = self.rules[rid]
+        self.rules[rid] = {"identity": "", "precedence": old.get("precedence"), **body, "id": rid, "created_at": old.get("created_at"), "updated_at": _now()}
+        self._ok(self.rules[rid])
+
+    def _rules_delete(self, rid, body, query):
+        if self.rules.pop(rid, None) is None: return self._error(404, 7003, "Rule not found")
+        self._ok({})
+
+    def do_GET(self):       self._handle("GET")
+    def do_POST(self):      self._handle("POST")
+    def do_PUT(self):       self._handle("PUT")
+    def do_PATCH(self):     self._handle("PATCH")
+    def do_DELETE(self):    self._handle("DELETE")
+
+def start_server(state: GatewayState, host: str = "127.0.0.1", port: int = 0) -> ThreadingHTTPServer:
+    handler = type("BoundGatewayHandler", (GatewayHandler,), {"state": state})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a local Cloudflare Gateway lists/rules API stand-in.")
+    parser.add_argument("--port", type=int, default=8787)
+    parser.add_argument("--rate-429", type=float, default=0.0, help="probability of answering 429 with Retry-After")
+    parser.add_argument("--rate-5xx", type=float, default=0.0, help="probability of answering 503")
+    parser.add_argument("--retry-after", type=float, default=1.0)
+    args = parser.parse_args()
+    srv = start_server(GatewayState(args.rate_429, args.rate_5xx, args.retry_after), port=args.port)
+    print(f"Fake gateway listening on http://127.0.0.1:{srv.server_port}/client/v4 (Ctrl+C to stop)")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        srv.shutdown()
@@ -5,13 +5,36 @@ import requests
 import concurrent.futures
 import time
 import hashlib
-import io
 import zipfile
+import zlib
 import gzip
-import sys
+import json
+import pickle
+import tempfile
+import mmap
+import struct
+import types
+import threading
+import asyncio
+import functools
+import itertools
+import multiprocessing
+import email.utils
+import argparse
+import signal
+import contextlib
+import resource
+import tracemalloc
+import heapq
+from array import array
 from requests.adapters import HTTPAdapter
 from urllib3.util import Retry
 
+try:
+    import zstandard
+except ImportError:   # optional: only needed for the "zstd" artifact format
+    zstandard = None
+
 # ---------------------------------------------------------------------------
 # 1. Config & Lists
 # ---------------------------------------------------------------------------
@@ -21,15 +44,41 @@ class Config:
     PRIMARY_EMAIL             = os.environ.get("PRIMARY_EMAIL", "")    
     SECONDARY_EMAIL           = os.environ.get("SECONDARY_EMAIL", "")  
     TERTIARY_EMAIL            = os.environ.get("TERTIARY_EMAIL", "")
+    API_BASE_URL              = os.environ.get("CF_API_BASE_URL", "https://api.cloudflare.com/client/v4")
+    ACCOUNTS_JSON             = os.environ.get("ACCOUNTS_JSON", "")   # multi-account fan-out, see load_accounts()
+    ACCOUNTS_FILE             = os.environ.get("ACCOUNTS_FILE", "")
     
     # --- TOGGLES ---
     ENABLE_RELEVANCE_FILTER = True
+    ENABLE_SOURCE_CACHE     = True
+    ENABLE_SUFFIX_COLLAPSE  = True
     
     MAX_LIST_SIZE             = 1000  
     MAX_RETRIES               = 5
     TOTAL_QUOTA               = 300_000
+    MAX_LISTS                 = TOTAL_QUOTA // MAX_LIST_SIZE
+    SLOT_FILL_TARGET          = 0.9   # average list fill when (re)sizing a hash-partitioned slot set
+    SLOT_MIN_FILL             = 0.6   # keep the current slot count until fill drops below this
+    ROLLOUT_MODE              = os.environ.get("ROLLOUT_MODE", "inplace")   # "inplace" or "bluegreen"
+    BLUEGREEN_MIN_CHANGED     = 0.5   # share of a policy's lists that must change before a new generation is written
+    RULE_SHARD_LISTS          = int(os.environ.get("RULE_SHARD_LISTS") or 0)   # lists per Gateway rule shard; 0 = one rule per policy
     REQUEST_TIMEOUT           = (5, 25)
     MAX_WORKERS               = 5
+    RELEVANCE_PROCESSES       = int(os.environ.get("RELEVANCE_PROCESSES", "0"))   # 0 = one per CPU, 1 = filter in the download threads
+    RELEVANCE_SHARD_MIN       = 50_000   # lists smaller than this are filtered in-thread; IPC would cost more than it saves
+    API_RATE_LIMIT            = 4.0   # sustained requests/second shared by the whole account (1200 per 5 min)
+    API_BURST                 = 10
+    API_MAX_CONCURRENCY       = 16
+    CACHE_DIR                 = os.environ.get("CACHE_DIR", ".cache")
+    MANIFEST_MAX_AGE          = 24 * 3600   # force a full remote crawl at least this often
+    POLL_INTERVAL             = int(os.environ.get("POLL_INTERVAL", "900"))   # --daemon: seconds between checks of a blocklist source
+    INVENTORY_CHECK_INTERVAL  = 3600   # --daemon: re-verify the in-memory remote inventory at least this often
+    COLLAPSE_MIN_ENTRIES      = 25     # listed subdomains an unlisted parent needs before it becomes a suffix match
+    COLLAPSE_MAX_EXPR_CHARS   = 4000   # per-policy budget for the generated suffix expression
+    METRICS_DIR               = os.environ.get("METRICS_DIR", "metrics")   # run_report.json + Prometheus textfile
+    TRACE_MEMORY              = os.environ.get("TRACE_MEMORY", "") == "1"   # tracemalloc per stage (slows the run noticeably)
+    ARTIFACT_FORMATS          = os.environ.get("ARTIFACT_FORMATS", "plain")   # comma-separated keys of ARTIFACTS
+    ARTIFACT_DIR              = os.environ.get("ARTIFACT_DIR", ".")
 
     # Targets to scrub orphaned rules/lists
     SCRUB_TARGETS = [
@@ -40,7 +89,8 @@ class Config:
 
     @classmethod
     def validate(cls):
-        required_vars = ("API_TOKEN", "ACCOUNT_ID", "PRIMARY_EMAIL")
+        multi_account = cls.ACCOUNTS_JSON or cls.ACCOUNTS_FILE
+        required_vars = ("PRIMARY_EMAIL",) if multi_account else ("API_TOKEN", "ACCOUNT_ID", "PRIMARY_EMAIL")
         missing = [k for k in required_vars if not getattr(cls, k)]
         if missing:
             raise EnvironmentError(f"Missing mandatory environment variables: {', '.join(missing)}")
@@ -52,11 +102,147 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-IP_PATTERN = re.compile(
-    r"^(?:(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\.){3}(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)$|"
-    r"^(?:[A-Fa-f0-9]{1,4}:){7}[A-Fa-f0-9]{1,4}$|"
-    r"^(?:[A-Fa-f0-9]{1,4}:)*:[A-Fa-f0-9]{1,4}(?::[A-Fa-f0-9]{1,4})*$"
-)
+def _wire_bytes(resp: requests.Response) -> int:
+    try:
+        return int(resp.raw.tell())
+    except (AttributeError, OSError, TypeError, ValueError):
+        return 0
+
+def _prom_escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+class RunMetrics:
+    # Per-run instrumentation: stage wall time and memory, per-source downloads, Cloudflare API traffic.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self, trace_memory: bool = False) -> None:
+        with self._lock:
+            self.started = time.time()
+            self.outcome = None
+            self.duration = 0.0
+            self.trace_memory = trace_memory
+            self.stages: dict[str, dict] = {}
+            self.downloads: dict[str, int] = {}
+            self.sources: dict[str, dict] = {}
+            self.api = {"calls": {}, "status": {}, "retries": 0, "throttled": 0, "bytes_sent": 0, "seconds": 0.0}
+            self.gauges: dict[tuple, float] = {}
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        tracing = self.trace_memory
+        if tracing:
+            if not tracemalloc.is_tracing(): tracemalloc.start()
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            entry = {"seconds": round(time.perf_counter() - start, 4), "maxrss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024}
+            if tracing:
+                current, peak = tracemalloc.get_traced_memory()
+                entry.update(tracemalloc_delta_bytes=current - before, tracemalloc_peak_bytes=peak - before)
+            with self._lock: self.stages[name] = entry
+
+    def record_download(self, url: str, nbytes: int) -> None:
+        with self._lock: self.downloads[url] = self.downloads.get(url, 0) + nbytes
+
+    def downloaded(self, url: str) -> int:
+        with self._lock: return self.downloads.pop(url, 0)
+
+    def record_source(self, name: str, **values) -> None:
+        # Numbers accumulate (a source may span several URLs); anything else is a label and is overwritten.
+        with self._lock:
+            entry = self.sources.setdefault(name, {})
+            for key, value in values.items():
+                entry[key] = entry.get(key, 0) + value if isinstance(value, (int, float)) else value
+
+    def record_api(self, method: str, status, sent: int, seconds: float, attempt: int) -> None:
+        with self._lock:
+            api = self.api
+            api["calls"][method] = api["calls"].get(method, 0) + 1
+            api["status"][str(status)] = api["status"].get(str(status), 0) + 1
+            api["bytes_sent"] += sent
+            api["seconds"] += seconds
+            if attempt > 1: api["retries"] += 1
+            if status == 429: api["throttled"] += 1
+
+    def set_gauge(self, name: str, value: float, **labels) -> None:
+        with self._lock: self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def finish(self, outcome: str) -> None:
+        self.outcome = outcome
+        self.duration = time.time() - self.started
+        if self.trace_memory and tracemalloc.is_tracing(): tracemalloc.stop()
+
+    def report(self) -> dict:
+        with self._lock:
+            return {
+                "started_at": self.started, "duration_seconds": round(self.duration, 3), "outcome": self.outcome,
+                "stages": dict(self.stages), "sources": {k: dict(v) for k, v in self.sources.items()},
+                "api": json.loads(json.dumps(self.api)),
+                "gauges": [{"name": name, "labels": dict(labels), "value": value} for (name, labels), value in self.gauges.items()],
+            }
+
+    def prometheus(self) -> str:
+        report, lines = self.report(), []
+        def family(name: str, help_text: str, samples) -> None:
+            samples = list(samples)
+            if not samples: return
+            lines.extend((f"# HELP blockads_{name} {help_text}", f"# TYPE blockads_{name} gauge"))
+            for labels, value in samples:
+                label_text = ",".join(f'{k}="{_prom_escape(v)}"' for k, v in labels.items())
+                lines.append(f"blockads_{name}{{{label_text}}} {value}" if label_text else f"blockads_{name} {value}")
+
+        family("run_timestamp_seconds", "Start time of the last run.", [({}, report["started_at"])])
+        family("run_duration_seconds", "Wall time of the last run.", [({}, report["duration_seconds"])])
+        family("run_success", "1 if the last run completed (sync or plan), else 0.", [({"outcome": report["outcome"]}, int(report["outcome"] in ("ok", "plan")))])
+        for key, help_text in (("seconds", "Stage wall time."), ("maxrss_bytes", "Peak RSS at the end of the stage."),
+                               ("tracemalloc_delta_bytes", "Net Python allocations retained by the stage."), ("tracemalloc_peak_bytes", "Peak Python allocations during the stage.")):
+            family(f"stage_{key}", help_text, (({"stage": stage}, entry[key]) for stage, entry in report["stages"].items() if key in entry))
+        for key, help_text in (("bytes", "Bytes downloaded."), ("seconds", "Download and parse time."), ("parsed", "Domains parsed."),
+                               ("kept", "Domains kept after relevance filtering."), ("pruned", "Domains pruned as irrelevant."), ("not_modified", "Fetches answered 304 Not Modified.")):
+            family(f"source_{key}", help_text, (({"source": name, "kind": entry.get("kind", "blocklist")}, entry[key]) for name, entry in report["sources"].items() if key in entry))
+        api = report["api"]
+        family("api_requests", "Cloudflare API requests in the last run, by method.", (({"method": m}, n) for m, n in api["calls"].items()))
+        family("api_responses", "Cloudflare API responses in the last run, by status.", (({"status": st}, n) for st, n in api["status"].items()))
+        family("api_retries", "Cloudflare API request attempts that were retries.", [({}, api["retries"])])
+        family("api_throttled", "Cloudflare API 429 responses.", [({}, api["throttled"])])
+        family("api_bytes_sent", "Request body bytes sent to the Cloudflare API.", [({}, api["bytes_sent"])])
+        family("api_seconds", "Summed Cloudflare API request latency.", [({}, round(api["seconds"], 3))])
+        for gauge in sorted({g["name"] for g in report["gauges"]}):
+            family(gauge, gauge.replace("_", " ").capitalize() + ".", ((g["labels"], g["value"]) for g in report["gauges"] if g["name"] == gauge))
+        return "\n".join(lines) + "\n"
+
+    def export(self, directory: str) -> None:
+        try:
+            os.makedirs(directory, exist_ok=True)
+            for filename, text in (("run_report.json", json.dumps(self.report(), indent=2)), ("block_ads_sync.prom", self.prometheus())):
+                fd, tmp = tempfile.mkstemp(dir=directory, suffix=".tmp")
+                with os.fdopen(fd, "w", encoding="utf-8") as f: f.write(text)
+                os.replace(tmp, os.path.join(directory, filename))
+            logger.info(f"Run metrics written to {directory}/")
+        except OSError as e:
+            logger.warning(f"Could not write run metrics: {e}")
+
+metrics = RunMetrics()
+
+# Hostname with at least one dot and a non-numeric TLD, so bare IPv4/IPv6 literals never match.
+_DOMAIN_RE = r"((?:[a-z0-9_-]+\.)+[a-z0-9_-]*[a-z_-][a-z0-9_-]*)\.?"
+_TRAILER_RE = r"[ \t\r]*(?:#.*)?$"
+BLOCKLIST_FORMATS = {
+    "plain":    re.compile(rf"^[ \t]*{_DOMAIN_RE}{_TRAILER_RE}", re.M),
+    "hosts":    re.compile(rf"^[ \t]*(?:\d{{1,3}}(?:\.\d{{1,3}}){{3}}|[0-9a-f]*:[0-9a-f:]*)[ \t]+{_DOMAIN_RE}{_TRAILER_RE}", re.M),
+    "abp":      re.compile(rf"^\|\|{_DOMAIN_RE}\^(?:\$important)?[ \t\r]*$", re.M),
+    "wildcard": re.compile(rf"^[ \t]*(?:\*\.)?{_DOMAIN_RE}{_TRAILER_RE}", re.M),
+}
+PARSE_CHUNK_SIZE = 1 << 20
+FORMAT_SAMPLE_LINES = 50                # non-comment lines read before a blocklist's format is picked
+TOP_LIST_BLOCK = 1 << 18                # top lists are decompressed and scanned in blocks of this size
+RELEVANCE_EXEMPT = {"HaGeZi Normal"}   # sources kept whole; the relevance filter never prunes them
+POLL_INTERVALS: dict[str, int] = {}    # --daemon: per-source overrides of Config.POLL_INTERVAL (seconds)
 
 BLOCKLIST_URLS = {
     "HaGeZi Normal": [
@@ -81,15 +267,24 @@ BLOCKLIST_URLS = {
 
 SPAM_TLD_URL = "https://cdn.jsdelivr.net/gh/hagezi/dns-blocklists@latest/wildcard/spam-tlds-onlydomains.txt"
 
+# Never collapsed into suffix matches: shared hosting and dynamic-DNS zones where siblings are unrelated sites.
+COLLAPSE_GUARD_SUFFIXES = {
+    "blogspot.com", "github.io", "gitlab.io", "herokuapp.com", "appspot.com", "azurewebsites.net", "cloudfront.net",
+    "amazonaws.com", "netlify.app", "vercel.app", "pages.dev", "workers.dev", "web.app", "firebaseapp.com",
+    "wordpress.com", "tumblr.com", "weebly.com", "wixsite.com", "duckdns.org", "no-ip.com", "ddns.net", "ngrok.io",
+}
+_SECOND_LEVEL_LABELS = {"co", "com", "net", "org", "gov", "edu", "ac", "ne", "or", "go", "gob", "mil", "nic", "ltd", "plc"}
+
 # Dynamic keyword-matching payload definition
 ADULT_KEYWORDS_EXPR = 'any(dns.domains[*] matches "(?i).*(blowjob|threesome|gangbang|deepthroat|bukkake|tits|fuck|onlyfans|porn|xxx|sex).*")'
 
-excluded_emails = [e for e in [Config.SECONDARY_EMAIL, Config.TERTIARY_EMAIL] if e]
-if excluded_emails:
-    emails_cond = " or ".join([f'identity.email == "{e}"' for e in excluded_emails])
-    TARGET_IDENTITY = f"not ({emails_cond})"
-else:
-    TARGET_IDENTITY = None
+def excluded_identity(emails) -> str | None:
+    emails = [e for e in emails if e]
+    if not emails: return None
+    emails_cond = " or ".join([f'identity.email == "{e}"' for e in emails])
+    return f"not ({emails_cond})"
+
+TARGET_IDENTITY = excluded_identity([Config.SECONDARY_EMAIL, Config.TERTIARY_EMAIL])
 
 POLICIES = [
     {
@@ -106,13 +301,15 @@ POLICIES = [
             "HaGeZi TIF Full",
         ], 
         "exclude": [],
-        "use_spam_tld": False
+        "use_spam_tld": False,
+        "weight": 2,   # quota priority when the compiled total exceeds TOTAL_QUOTA (higher keeps first)
     },
     {
         "prefix": "L_Restrictive", 
         "policy_name": "Block: Restrictive Profile", 
         "action": "block", 
         "identity_condition": TARGET_IDENTITY, 
+        "account_identity": True,   # per-account "excluded_emails" replace identity_condition
         "category_condition": "any(dns.security_category[*] in {151 191 188 68}) or any(dns.content_category[*] in {67 125})",
         "include": [
             #"HaGeZi Pro", 
@@ -123,7 +320,8 @@ POLICIES = [
             "NoAI",
         ], 
         "exclude": ["HaGeZi Normal"],
-        "use_spam_tld": False
+        "use_spam_tld": False,
+        "weight": 1,
     }
 ]
 
@@ -131,137 +329,776 @@ POLICIES = [
 # ---------------------------------------------------------------------------
 # 2. Cloudflare API Client
 # ---------------------------------------------------------------------------
+class RateLimiter:
+    # Account-wide token bucket. A 429 pauses every caller until its Retry-After deadline.
+    def __init__(self, rate: float, burst: int):
+        self.rate, self.burst = rate, burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float) -> None:
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class AdaptiveConcurrency:
+    # AIMD: each success widens the window by ~1 per window's worth of calls, each 429 halves it.
+    def __init__(self, initial: int, maximum: int):
+        self.limit, self.maximum = float(initial), maximum
+        self.active = 0
+        self._cond = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self._cond:
+            await self._cond.wait_for(lambda: self.active < int(self.limit))
+            self.active += 1
+
+    async def __aexit__(self, *exc):
+        async with self._cond:
+            self.active -= 1
+            self._cond.notify_all()
+
+    def on_success(self) -> None:   self.limit = min(self.maximum, self.limit + 1 / self.limit)
+    def on_throttle(self) -> None:  self.limit = max(1.0, self.limit / 2)
+
+def _retry_after(resp: requests.Response) -> float | None:
+    value = resp.headers.get("Retry-After")
+    if not value: return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        try:
+            return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
 class CloudflareAPI:
-    def __init__(self):
-        self.base_url = f"https://api.cloudflare.com/client/v4/accounts/{Config.ACCOUNT_ID}/gateway"
-        self.headers = {"Authorization": f"Bearer {Config.API_TOKEN}", "Content-Type": "application/json"}
+    def __init__(self, account_id: str = None, api_token: str = None):
+        self.base_url = f"{Config.API_BASE_URL.rstrip('/')}/accounts/{account_id or Config.ACCOUNT_ID}/gateway"
+        self.headers = {"Authorization": f"Bearer {api_token or Config.API_TOKEN}", "Content-Type": "application/json"}
         self.session = requests.Session()
-        retry = Retry(total=Config.MAX_RETRIES, backoff_factor=2, status_forcelist=[500, 502, 503, 504])
-        adapter = HTTPAdapter(pool_connections=Config.MAX_WORKERS, pool_maxsize=Config.MAX_WORKERS + 2, max_retries=retry)
+        adapter = HTTPAdapter(pool_connections=Config.API_MAX_CONCURRENCY, pool_maxsize=Config.API_MAX_CONCURRENCY + 2, max_retries=0)
         self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.limiter = RateLimiter(Config.API_RATE_LIMIT, Config.API_BURST)
+        self.concurrency = AdaptiveConcurrency(Config.MAX_WORKERS, Config.API_MAX_CONCURRENCY)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=Config.API_MAX_CONCURRENCY)
 
-    def _request(self, method, endpoint, **kwargs):
-        retries = Config.MAX_RETRIES
+    async def _request(self, method, endpoint, **kwargs):
         delay = 2
         resp = None
-        while retries > 0:
+        loop = asyncio.get_running_loop()
+        call = functools.partial(self.session.request, method, f"{self.base_url}/{endpoint}", headers=self.headers, timeout=Config.REQUEST_TIMEOUT, **kwargs)
+        for attempt in range(1, Config.MAX_RETRIES + 1):
+            retries = Config.MAX_RETRIES - attempt
             try:
-                resp = self.session.request(method, f"{self.base_url}/{endpoint}", headers=self.headers, timeout=Config.REQUEST_TIMEOUT, **kwargs)
-                
-                if resp.status_code in [429, 500, 502, 503, 504]:
-                    retries -= 1
-                    logger.warning(f"Transient API Error ({resp.status_code}) on {endpoint}. Retrying in {delay}s... ({retries} left)")
-                    time.sleep(delay)
-                    delay *= 2 
-                    continue
-                    
-                if not resp.ok:
-                    logger.error(f"Cloudflare API Error [{resp.status_code}]: {resp.text}")
-                resp.raise_for_status()
-                return resp.json()
-                
+                async with self.concurrency:
+                    await self.limiter.acquire()
+                    sent_at = time.perf_counter()
+                    resp = await loop.run_in_executor(self._executor, call)
+                metrics.record_api(method, resp.status_code, len(resp.request.body or b""), time.perf_counter() - sent_at, attempt)
             except requests.exceptions.RequestException as exc:
-                retries -= 1
-                if retries == 0:
-                    raise exc
+                metrics.record_api(method, "error", 0, time.perf_counter() - sent_at, attempt)
+                if not retries: raise exc
                 logger.warning(f"Network error/timeout on {endpoint}: {exc}. Retrying in {delay}s... ({retries} left)")
-                time.sleep(delay)
+                await asyncio.sleep(delay)
+                delay *= 2
+                continue
+
+            if resp.status_code == 429:
+                wait = _retry_after(resp) or delay
+                self.limiter.pause(wait)
+                self.concurrency.on_throttle()
+                logger.warning(f"Rate limited (429) on {endpoint}. Pausing all requests for {wait:.1f}s, concurrency now {int(self.concurrency.limit)}... ({retries} left)")
+                delay *= 2
+                continue
+
+            if resp.status_code in [500, 502, 503, 504]:
+                logger.warning(f"Transient API Error ({resp.status_code}) on {endpoint}. Retrying in {delay}s... ({retries} left)")
+                await asyncio.sleep(delay)
                 delay *= 2
+                continue
+
+            self.concurrency.on_success()
+            if not resp.ok:
+                logger.error(f"Cloudflare API Error [{resp.status_code}]: {resp.text}")
+            resp.raise_for_status()
+            return resp.json()
 
         raise requests.exceptions.HTTPError("Exhausted retries due to persistent Cloudflare API dropouts.", response=resp)
 
-    def _get_paginated(self, endpoint):
-        results, page = [], 1
-        while True:
-            resp = self._request("GET", f"{endpoint}?page={page}&per_page=100")
-            data = resp.get("result") or []
-            results.extend(data)
-            info = resp.get("result_info")
-            if not info or page >= info.get("total_pages", 1): break
-            page += 1
+    def close(self) -> None:
+        self._executor.shutdown(wait=False)
+        self.session.close()
+
+    async def _get_paginated(self, endpoint):
+        first = await self._request("GET", f"{endpoint}?page=1&per_page=100")
+        results = list(first.get("result") or [])
+        total_pages = (first.get("result_info") or {}).get("total_pages", 1)
+        if total_pages > 1:
+            pages = await asyncio.gather(*(self._request("GET", f"{endpoint}?page={page}&per_page=100") for page in range(2, total_pages + 1)))
+            for resp in pages: results.extend(resp.get("result") or [])
         return results
 
+    async def get_page(self, endpoint, page=1) -> tuple[list[dict], int]:
+        resp = await self._request("GET", f"{endpoint}?page={page}&per_page=100")
+        data = resp.get("result") or []
+        return data, (resp.get("result_info") or {}).get("total_count", len(data))
+
     def get_lists(self):                                        return self._get_paginated("lists")
     def get_rules(self):                                        return self._get_paginated("rules")
     def delete_list(self, lid):                                 return self._request("DELETE", f"lists/{lid}")
     def delete_rule(self, rid):                                 return self._request("DELETE", f"rules/{rid}")
     def create_list(self, name, items, desc=""):              return self._request("POST",    "lists",        json={"name": name, "type": "DOMAIN", "items": items, "description": desc})
     def update_list(self, lid, name, items, desc=""):          return self._request("PUT",     f"lists/{lid}", json={"name": name, "items": items, "description": desc})
+    def update_list_meta(self, lid, name, desc=""):            return self._request("PUT",     f"lists/{lid}", json={"name": name, "description": desc})
+    def patch_list(self, lid, append, remove):                  return self._request("PATCH",   f"lists/{lid}", json={"append": [{"value": d} for d in append], "remove": remove})
     def create_rule(self, data):                                return self._request("POST",    "rules",        json={**data, "rule_settings": {"block_page_enabled": False}})
     def update_rule(self, rid, data):                           return self._request("PUT",     f"rules/{rid}", json={**data, "rule_settings": {"block_page_enabled": False}})
 
+class RemoteInventory:
+    LIST_FIELDS = ("id", "name", "description", "count", "updated_at")
+    RULE_FIELDS = ("id", "name", "action", "enabled", "precedence", "traffic", "identity", "updated_at")
+
+    def __init__(self, lists: list[dict], rules: list[dict]):
+        self._lock = threading.Lock()
+        self.lists, self.rules = {}, {}
+        self._list_names, self._rule_names = {}, {}
+        for l in lists: self.put_list(l)
+        for r in rules: self.put_rule(r)
+
+    def put_list(self, lst: dict) -> None:
+        entry = {k: lst.get(k) for k in self.LIST_FIELDS}
+        with self._lock:
+            self.lists[entry["id"]] = entry
+            self._list_names[entry["name"]] = entry
+
+    def put_rule(self, rule: dict) -> None:
+        entry = {k: rule.get(k) for k in self.RULE_FIELDS}
+        entry["traffic"], entry["identity"] = entry["traffic"] or "", entry["identity"] or ""
+        with self._lock:
+            self.rules[entry["id"]] = entry
+            self._rule_names[entry["name"]] = entry
+
+    def drop_list(self, lid: str) -> None:
+        with self._lock:
+            entry = self.lists.pop(lid, None)
+            if entry and self._list_names.get(entry["name"]) is entry: del self._list_names[entry["name"]]
+
+    def drop_rule(self, rid: str) -> None:
+        with self._lock:
+            entry = self.rules.pop(rid, None)
+            if entry and self._rule_names.get(entry["name"]) is entry: del self._rule_names[entry["name"]]
+
+    def list_named(self, name: str) -> dict | None:   return self._list_names.get(name)
+    def rule_named(self, name: str) -> dict | None:   return self._rule_names.get(name)
+
+    def all_lists(self) -> list[dict]:
+        with self._lock: return list(self.lists.values())
+
+    def all_rules(self) -> list[dict]:
+        with self._lock: return list(self.rules.values())
+
+    def lists_with_prefix(self, prefix: str) -> dict[str, dict]:
+        return {l["name"]: l for l in self.all_lists() if l["name"].startswith(prefix + " ")}
+
+class SyncManifest:
+    VERSION = 2
+
+    def __init__(self, path: str):
+        self.path = path
+        self.crawled_at = 0.0
+        self.probe = 0
+
+    def _read(self) -> dict | None:
+        try:
+            with open(self.path, encoding="utf-8") as f: state = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return state if state.get("version") == self.VERSION else None
+
+    def invalidate(self) -> None:
+        if os.path.exists(self.path): os.unlink(self.path)
+
+    def save(self, inventory: RemoteInventory) -> None:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        state = {"version": self.VERSION, "crawled_at": self.crawled_at, "probe": self.probe, "saved_at": time.time(), "lists": inventory.all_lists(), "rules": inventory.all_rules()}
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f: json.dump(state, f)
+        os.replace(tmp, self.path)
+
+    @staticmethod
+    def _page_matches(page: list[dict], known: dict[str, dict], fields: tuple[str, ...]) -> bool:
+        for item in page:
+            entry = known.get(item.get("id"))
+            if entry is None or any(entry.get(k) != item.get(k) for k in fields if k != "id"): return False
+        return True
+
+    async def load_inventory(self, cf: CloudflareAPI) -> RemoteInventory:
+        state = self._read()
+        self.probe = (state or {}).get("probe", 0) + 1
+        if state and time.time() - state.get("crawled_at", 0) < Config.MANIFEST_MAX_AGE:
+            cached = RemoteInventory(state["lists"], state["rules"])
+            # Each run compares a different page of lists and rules, so an edit made outside the sync is
+            # found within as many runs as there are pages, and by the MANIFEST_MAX_AGE crawl at the latest.
+            list_pages, rule_pages = (max(1, -(-len(known) // 100)) for known in (cached.lists, cached.rules))
+            (list_page, list_total), (rule_page, rule_total) = await asyncio.gather(
+                cf.get_page("lists", state.get("probe", 0) % list_pages + 1), cf.get_page("rules", state.get("probe", 0) % rule_pages + 1)
+            )
+            if (
+                list_total == len(cached.lists) and rule_total == len(cached.rules)
+                and self._page_matches(list_page, cached.lists, ("name", "description", "updated_at"))
+                and self._page_matches(rule_page, cached.rules, ("name", "enabled", "traffic", "updated_at"))
+            ):
+                self.crawled_at = state["crawled_at"]
+                logger.info(f"Sync manifest matches remote state ({list_total} lists, {rule_total} rules). Skipping full crawl.")
+                return cached
+            logger.info("Sync manifest disagrees with remote state. Falling back to a full crawl.")
+
+        lists, rules = await asyncio.gather(cf.get_lists(), cf.get_rules())
+        inventory = RemoteInventory(lists, rules)
+        self.crawled_at = time.time()
+        return inventory
+
+# ---------------------------------------------------------------------------
+# 3. Conditional-GET Source Cache
+# ---------------------------------------------------------------------------
+class SourceCache:
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def _paths(self, url: str) -> tuple[str, str]:
+        key = hashlib.sha256(url.encode("utf-8")).hexdigest()[:24]
+        return os.path.join(self.root, f"{key}.json"), os.path.join(self.root, f"{key}.pkl")
+
+    def _atomic_write(self, path: str, data: bytes) -> None:
+        fd, tmp = tempfile.mkstemp(dir=self.root, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f: f.write(data)
+            os.replace(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp): os.unlink(tmp)
+            raise
+
+    def _read_meta(self, url: str, tag: str) -> dict:
+        meta_path, payload_path = self._paths(url)
+        try:
+            with open(meta_path, encoding="utf-8") as f: meta = json.load(f)
+        except (OSError, ValueError): return {}
+        if meta.get("url") != url or meta.get("tag") != tag or not os.path.exists(payload_path): return {}
+        return meta
+
+    def load(self, url: str, tag: str):
+        if not self._read_meta(url, tag): return None
+        try:
+            with open(self._paths(url)[1], "rb") as f: return pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError) as exc:
+            logger.warning(f"Discarding unreadable cache entry for {url}: {exc}")
+            return None
+
+    def store(self, url: str, tag: str, payload, resp: requests.Response) -> None:
+        meta_path, payload_path = self._paths(url)
+        meta = {
+            "url": url, "tag": tag, "stored_at": time.time(),
+            "etag": resp.headers.get("ETag"), "last_modified": resp.headers.get("Last-Modified"),
+        }
+        try:
+            self._atomic_write(payload_path, pickle.dumps(payload, protocol=pickle.HIGHEST_PROTOCOL))
+            self._atomic_write(meta_path, json.dumps(meta).encode("utf-8"))
+        except OSError as exc:
+            logger.warning(f"Could not persist cache entry for {url}: {exc}")
+
+    def fetch(self, session: requests.Session, url: str, parse, tag: str, reuse: bool = True, **kwargs) -> tuple[object, bool]:
+        meta = self._read_meta(url, tag)
+        headers = dict(kwargs.pop("headers", None) or {})
+        conditional = dict(headers)
+        if meta.get("etag"): conditional["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"): conditional["If-Modified-Since"] = meta["last_modified"]
+
+        with session.get(url, headers=conditional, stream=True, **kwargs) as resp:
+            if resp.status_code == 304:
+                if not reuse: return None, False
+                payload = self.load(url, tag)
+                if payload is not None:
+                    logger.info(f"Source unchanged (304), reusing cached parse: {url}")
+                    return payload, False
+            else:
+                resp.raise_for_status()
+                try:
+                    result = parse(resp)
+                except BlocklistParseError as exc:
+                    # Never cache an empty parse under the upstream validators; keep the last good copy instead.
+                    payload = self.load(url, tag)
+                    if payload is None: raise
+                    logger.warning(f"{exc}. Keeping the last good copy.")
+                    return payload, False
+                metrics.record_download(url, _wire_bytes(resp))
+                self.store(url, tag, result, resp)
+                return result, True
+
+        with session.get(url, headers=headers, stream=True, **kwargs) as resp:
+            resp.raise_for_status()
+            result = parse(resp)
+            metrics.record_download(url, _wire_bytes(resp))
+        self.store(url, tag, result, resp)
+        return result, True
+
+def fetch_source(session: requests.Session, url: str, parse, tag: str, cache: SourceCache = None, reuse: bool = True, **kwargs) -> tuple[object, bool]:
+    if cache: return cache.fetch(session, url, parse, tag, reuse=reuse, **kwargs)
+    with session.get(url, stream=True, **kwargs) as resp:
+        resp.raise_for_status()
+        result = parse(resp)
+        metrics.record_download(url, _wire_bytes(resp))
+        return result, True
+
 # ---------------------------------------------------------------------------
-# 3. Relevance Filtering & Domain Logic
+# 4. Relevance Filtering & Domain Logic
 # ---------------------------------------------------------------------------
+# ttl: how long a fetched copy is trusted before the source is checked again (seconds).
+# max_rank: rows read before the download is dropped (None = the whole list); lower it to trade relevance coverage
+# for download time, e.g. 1_000_000 for DomCop's 10M rows.
 TOP_LISTS = [
-    ("https://tranco-list.eu/top-1m.csv.zip", 1, False, "zip"),
-    ("http://s3-us-west-1.amazonaws.com/umbrella-static/top-1m.csv.zip", 1, False, "zip"),
-    ("https://raw.githubusercontent.com/zakird/crux-top-lists/main/data/global/current.csv.gz", 0, True, "gzip"),
-    ("https://downloads.majestic.com/majestic_million.csv", 2, True, "raw"),
-    ("https://www.domcop.com/files/top/top10milliondomains.csv.zip", 1, True, "zip"),
-    ("https://builtwith.com/dl/builtwith-top1m.zip", 0, False, "zip"),
+    {"name": "tranco",    "url": "https://tranco-list.eu/top-1m.csv.zip",                                                   "col": 1, "skip_header": False, "compression": "zip",  "ttl": 24 * 3600,     "max_rank": None},
+    {"name": "umbrella",  "url": "http://s3-us-west-1.amazonaws.com/umbrella-static/top-1m.csv.zip",                        "col": 1, "skip_header": False, "compression": "zip",  "ttl": 24 * 3600,     "max_rank": None},
+    {"name": "crux",      "url": "https://raw.githubusercontent.com/zakird/crux-top-lists/main/data/global/current.csv.gz", "col": 0, "skip_header": True,  "compression": "gzip", "ttl": 7 * 24 * 3600, "max_rank": None},
+    {"name": "majestic",  "url": "https://downloads.majestic.com/majestic_million.csv",                                     "col": 2, "skip_header": True,  "compression": "raw",  "ttl": 24 * 3600,     "max_rank": None},
+    {"name": "domcop",    "url": "https://www.domcop.com/files/top/top10milliondomains.csv.zip",                            "col": 1, "skip_header": True,  "compression": "zip",  "ttl": 7 * 24 * 3600, "max_rank": None},
+    {"name": "builtwith", "url": "https://builtwith.com/dl/builtwith-top1m.zip",                                            "col": 0, "skip_header": False, "compression": "zip",  "ttl": 7 * 24 * 3600, "max_rank": None},
 ]
 
-def has_suffix_match(host: str, lookup_set: set[str]) -> bool:
-    if host in lookup_set: return True
-    parts = host.split('.')
-    for i in range(1, len(parts)):
-        if '.'.join(parts[i:]) in lookup_set: return True
-    return False
-
-def _parse_csv_lines(iterable, col_idx: int, skip_header: bool) -> set[str]:
-    domains = set()
-    for i, line in enumerate(iterable):
-        if skip_header and i == 0: continue
-        parts = line.split(',')
-        if len(parts) > col_idx:
-            dom = parts[col_idx].strip().lower().strip('"')
-            if dom and "." in dom: domains.add(dom)
+class RelevanceDataError(RuntimeError):
+    pass
+
+_ZIP_LOCAL_HEADER = struct.Struct("<IHHHHHIIIHH")
+
+def _column_pattern(col_idx: int) -> re.Pattern:
+    # Byte scan for one CSV column; a leading scheme (CrUX lists origins), "www." and any port or path are left out.
+    # A row whose host has no dot still matches (as b"") so the ordinal stays the rank.
+    return re.compile(rb'^(?!$)(?:[^,\n]*,){%d}[ \t"]*(?:[a-z][a-z0-9+.-]*://)?(?:www\.)?([^,"/:\s.]*\.[^,"/:\s]*)?' % col_idx, re.M)
+
+def _spool_zip(head: bytes, chunks):
+    # Fallback for members that can't be inflated from the stream (stored, or an unexpected header): spool to disk.
+    with tempfile.TemporaryFile() as tmp:
+        tmp.write(head)
+        for chunk in chunks: tmp.write(chunk)
+        tmp.seek(0)
+        with zipfile.ZipFile(tmp) as z, z.open(z.namelist()[0]) as member:
+            while block := member.read(TOP_LIST_BLOCK): yield block
+
+def _inflate_zip(chunks):
+    # Inflate the first member straight off the wire from its local header; the central directory is never needed.
+    chunks, buf = iter(chunks), b""
+    while len(buf) < _ZIP_LOCAL_HEADER.size and (chunk := next(chunks, None)) is not None: buf += chunk
+    sig, _, _, method, _, _, _, _, _, name_len, extra_len = _ZIP_LOCAL_HEADER.unpack_from(buf.ljust(_ZIP_LOCAL_HEADER.size, b"\0"))
+    if sig != 0x04034B50 or method != zipfile.ZIP_DEFLATED:
+        yield from _spool_zip(buf, chunks)
+        return
+    start = _ZIP_LOCAL_HEADER.size + name_len + extra_len
+    while len(buf) < start and (chunk := next(chunks, None)) is not None: buf += chunk
+    inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+    for chunk in itertools.chain([buf[start:]], chunks):
+        while chunk and not inflater.eof:
+            yield inflater.decompress(chunk, TOP_LIST_BLOCK)
+            chunk = inflater.unconsumed_tail
+        if inflater.eof: break
+    yield inflater.flush()
+
+def _gunzip(chunks):
+    inflater = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        while chunk:   # bounded output per call so a highly compressible block can't balloon
+            yield inflater.decompress(chunk, TOP_LIST_BLOCK)
+            chunk = inflater.unconsumed_tail
+            if inflater.eof:   # concatenated gzip members
+                chunk = inflater.unused_data
+                inflater = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    yield inflater.flush()
+
+def _project_column(blocks, col_idx: int, skip_header: bool, max_rank: int = None) -> dict[bytes, int]:
+    # Top lists are ordered by popularity, so the row number is the rank; a repeated domain keeps its first
+    # (best) row. Stops reading as soon as max_rank rows have been seen.
+    pattern = _column_pattern(col_idx)
+    domains, rank, tail, header = {}, 0, b"", skip_header
+    for block in itertools.chain(blocks, [b"\n"]):
+        buf = tail + block
+        cut = buf.rfind(b"\n") + 1
+        if not cut:
+            tail = buf
+            continue
+        tail, text = buf[cut:], buf[:cut].lower()
+        if header:
+            text, header = text[text.find(b"\n") + 1:], False
+        found = pattern.findall(text)
+        if max_rank: found = found[:max_rank - rank]
+        for rank, dom in enumerate(found, rank + 1): domains.setdefault(dom, rank)
+        if max_rank and rank >= max_rank: break
+    domains.pop(b"", None)
     return domains
 
-def fetch_top_list(url: str, col_idx: int, skip_header: bool, compression: str, session: requests.Session) -> set[str]:
-    try:
-        r = session.get(url, headers={"User-Agent": "Mozilla/5.0"}, timeout=90)
+def fetch_top_list(source: dict, session: requests.Session, validators: dict = None) -> tuple[tuple[array, array] | None, dict]:
+    # Conditional GET against the validators of the last good copy; returns (hashes, ranks), or None on 304 Not Modified.
+    # The body is decompressed as it arrives and the download is dropped once max_rank rows are in.
+    headers = {"User-Agent": "Mozilla/5.0"}
+    validators = validators or {}
+    if validators.get("etag"): headers["If-None-Match"] = validators["etag"]
+    if validators.get("last_modified"): headers["If-Modified-Since"] = validators["last_modified"]
+
+    with session.get(source["url"], headers=headers, stream=True, timeout=90) as r:
+        if r.status_code == 304: return None, validators
         r.raise_for_status()
-        if compression == "zip":
-            with zipfile.ZipFile(io.BytesIO(r.content)) as z:
-                with io.TextIOWrapper(z.open(z.namelist()[0]), encoding='utf-8', errors='ignore') as f:
-                    return _parse_csv_lines(f, col_idx, skip_header)
-        elif compression == "gzip":
-            with gzip.GzipFile(fileobj=io.BytesIO(r.content)) as gz:
-                with io.TextIOWrapper(gz, encoding='utf-8', errors='ignore') as f:
-                    return _parse_csv_lines(f, col_idx, skip_header)
-        else:
-            return _parse_csv_lines(r.text.splitlines(), col_idx, skip_header)
-    except Exception as e:
-        logger.critical(f"Critical failure fetching top list {url}: {e}", exc_info=True)
-        sys.exit(1)
+        chunks = r.iter_content(chunk_size=TOP_LIST_BLOCK)
+        if source["compression"] == "zip": chunks = _inflate_zip(chunks)
+        elif source["compression"] == "gzip": chunks = _gunzip(chunks)
+        domains = _project_column(chunks, source["col"], source["skip_header"], source.get("max_rank"))
+        metrics.record_download(source["url"], _wire_bytes(r))
+        data = (array("Q", map(domain_hash, domains)), array("I", domains.values()))
+        return data, {"etag": r.headers.get("ETag"), "last_modified": r.headers.get("Last-Modified")}
+
+def domain_hash(data: bytes) -> int:
+    # 64-bit digest that is stable across processes (unlike hash()); 0 marks an empty slot.
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "little") or 1
+
+class RelevanceIndex:
+    # Open-addressing table of 64-bit domain digests with a parallel uint32 array holding each domain's
+    # best popularity rank, laid out flat on disk so it can be mmapped.
+    MAGIC, VERSION = b"RLIX", 2
+    HEADER = struct.Struct("<4sIQQ")
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, "rb")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.count, slots = self.HEADER.unpack_from(self._mmap, 0)
+        if magic != self.MAGIC or version != self.VERSION or len(self._mmap) != self.HEADER.size + slots * 12:
+            self.close()
+            raise ValueError(f"Corrupt or incompatible relevance index: {path}")
+        view = memoryview(self._mmap)
+        self._table = view[self.HEADER.size:self.HEADER.size + slots * 8].cast("Q")
+        self._ranks = view[self.HEADER.size + slots * 8:].cast("I")
+        view.release()
+        self._mask = slots - 1
+
+    def __len__(self) -> int:
+        return self.count
+
+    def close(self) -> None:
+        for name in ("_table", "_ranks"):
+            if getattr(self, name, None) is not None: getattr(self, name).release()
+            setattr(self, name, None)
+        self._mmap.close()
+        self._file.close()
+
+    @classmethod
+    def build(cls, path: str, sources) -> "RelevanceIndex":
+        # sources: iterable of (hashes, ranks) array pairs, one per top list.
+        hashes, ranks = array("Q"), array("I")
+        for chunk_hashes, chunk_ranks in sources:
+            hashes.extend(chunk_hashes)
+            ranks.extend(chunk_ranks)
+
+        slots = max(8, 1 << (len(hashes) * 10 // 7).bit_length())
+        mask, count = slots - 1, 0
+        table = array("Q", bytes(slots * 8))
+        best = array("I", bytes(slots * 4))
+        for h, r in zip(hashes, ranks):
+            i = h & mask
+            while True:
+                v = table[i]
+                if v == h:
+                    if r < best[i]: best[i] = r
+                    break
+                if v == 0:
+                    table[i] = h
+                    best[i] = r
+                    count += 1
+                    break
+                i = (i + 1) & mask
+        del hashes, ranks
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp = f"{path}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(cls.HEADER.pack(cls.MAGIC, cls.VERSION, count, slots))
+            table.tofile(f)
+            best.tofile(f)
+        os.replace(tmp, path)
+        return cls(path)
+
+    def _slot(self, h: int) -> int:
+        table, mask = self._table, self._mask
+        i = h & mask
+        while True:
+            v = table[i]
+            if v == h: return i
+            if v == 0: return -1
+            i = (i + 1) & mask
+
+    def contains_suffix(self, host: str) -> bool:
+        data = host.encode("utf-8")
+        if self._slot(domain_hash(data)) >= 0: return True
+        pos = data.find(b".")
+        while pos != -1:
+            if self._slot(domain_hash(data[pos + 1:])) >= 0: return True
+            pos = data.find(b".", pos + 1)
+        return False
+
+    def best_rank(self, host: str) -> int:
+        # Best (lowest) rank of the host or any parent domain; 0 when none of them is listed.
+        data, best, pos = host.encode("utf-8"), 0, -1
+        while True:
+            i = self._slot(domain_hash(data[pos + 1:]))
+            if i >= 0:
+                r = self._ranks[i]
+                if not best or r < best: best = r
+            pos = data.find(b".", pos + 1)
+            if pos == -1: return best
+
+class RelevanceDataset:
+    # Per-source hash arrays plus a manifest, kept apart from the blocklist cache. Each source is only
+    # re-checked once its TTL lapses, and the index is only re-merged when some source's data changed.
+    # Array files carry their revision, so a manifest restored alongside other data never pairs with it.
+    VERSION = 3
+
+    def __init__(self, root: str):
+        self.root = root
+        self.manifest_path = os.path.join(root, "manifest.json")
+        self.index_path = os.path.join(root, "relevance.idx")
+        self.revisions: dict[str, int] | None = None
+
+    def _paths(self, name: str, revision: int) -> tuple[str, str]:
+        return os.path.join(self.root, f"{name}.{revision}.hashes"), os.path.join(self.root, f"{name}.{revision}.ranks")
+
+    def _has_data(self, name: str, entry: dict) -> bool:
+        return "revision" in entry and all(os.path.exists(p) for p in self._paths(name, entry["revision"]))
+
+    def _load_manifest(self) -> dict:
+        try:
+            with open(self.manifest_path, encoding="utf-8") as f: manifest = json.load(f)
+            if manifest.get("version") == self.VERSION: return manifest
+        except (OSError, ValueError):
+            pass
+        return {"version": self.VERSION, "sources": {}, "index": None}
+
+    def _write_atomic(self, path: str, write) -> None:
+        fd, tmp = tempfile.mkstemp(dir=self.root, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f: write(f)
+            os.replace(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp): os.unlink(tmp)
+            raise
+
+    def _read_source(self, name: str, revision: int) -> tuple[array, array]:
+        hashes, ranks = array("Q"), array("I")
+        hashes_path, ranks_path = self._paths(name, revision)
+        with open(hashes_path, "rb") as f: hashes.frombytes(f.read())
+        with open(ranks_path, "rb") as f: ranks.frombytes(f.read())
+        if len(hashes) != len(ranks): raise ValueError(f"Relevance data for {name} is inconsistent")
+        return hashes, ranks
+
+    @staticmethod
+    def _spec(source: dict) -> str:
+        return f"{source['url']}#{source['col']}:{int(source['skip_header'])}:{source['compression']}:{source.get('max_rank') or ''}:v2"
+
+    def next_check(self) -> float:
+        sources = self._load_manifest()["sources"]
+        return min(sources.get(s["name"], {}).get("checked_at", 0) + s["ttl"] for s in TOP_LISTS)
+
+    def refresh(self, session: requests.Session, max_workers: int = 5) -> RelevanceIndex:
+        os.makedirs(self.root, exist_ok=True)
+        manifest, now = self._load_manifest(), time.time()
+        entries = {s["name"]: manifest["sources"][s["name"]] for s in TOP_LISTS if s["name"] in manifest["sources"]}
+
+        def is_stale(source: dict) -> bool:
+            entry = entries.get(source["name"])
+            return (
+                entry is None or entry.get("spec") != self._spec(source)
+                or now - entry.get("checked_at", 0) >= source["ttl"]
+                or not self._has_data(source["name"], entry)
+            )
+
+        stale = [s for s in TOP_LISTS if is_stale(s)]
+        if stale:
+            logger.info(f"Refreshing {len(stale)} relevance source(s) past their TTL: {', '.join(s['name'] for s in stale)}")
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = {}
+                for s in stale:
+                    entry = entries.get(s["name"], {})
+                    validators = entry if entry.get("spec") == self._spec(s) and self._has_data(s["name"], entry) else {}
+                    futures[executor.submit(fetch_top_list, s, session, validators)] = s
+                for future in concurrent.futures.as_completed(futures):
+                    source = futures.pop(future)
+                    name = source["name"]
+                    try:
+                        data, validators = future.result()
+                        metrics.record_source(name, kind="toplist", bytes=metrics.downloaded(source["url"]), parsed=len(data[0]) if data is not None else 0, not_modified=int(data is None))
+                    except Exception as e:
+                        fallback = "keeping last-known-good copy" if name in entries else "no previous copy, source left out"
+                        logger.warning(f"Top list {name} unavailable ({e}); {fallback}.")
+                        continue
+                    entry = entries.setdefault(name, {})
+                    if data is not None:
+                        # Time-based, so a manifest rebuilt from scratch never reuses the name of an older generation.
+                        revision = max(entry.get("revision", 0) + 1, int(now))
+                        for path, values in zip(self._paths(name, revision), data): self._write_atomic(path, values.tofile)
+                        entry.update(validators, spec=self._spec(source), revision=revision, count=len(data[0]))
+                        logger.info(f"Top list {name} updated: {len(data[0]):,} domains")
+                    entry["checked_at"] = now
+
+        available = {name: e["revision"] for name, e in entries.items() if self._has_data(name, e)}
+        keep = {os.path.basename(path) for name, revision in available.items() for path in self._paths(name, revision)}
+        for fname in os.listdir(self.root):
+            if fname.endswith((".hashes", ".ranks")) and fname not in keep: os.unlink(os.path.join(self.root, fname))
+
+        if not available:
+            raise RelevanceDataError("No relevance source data available and no previous copy to fall back on")
+
+        index = None
+        if manifest.get("index") == available:
+            try:
+                index = RelevanceIndex(self.index_path)
+            except (OSError, ValueError):
+                index = None
+        if index is None:
+            logger.info(f"Merging relevance index from {len(available)} source(s)...")
+            index = RelevanceIndex.build(self.index_path, (self._read_source(name, revision) for name, revision in available.items()))
+
+        manifest.update(sources=entries, index=available)
+        self._write_atomic(self.manifest_path, lambda f: f.write(json.dumps(manifest, indent=1).encode("utf-8")))
+        self.revisions = available
+        return index
+
+def relevance_key(domain: str) -> str:
+    domain = domain.lower().strip('.')
+    return domain[4:] if domain.startswith("www.") else domain
+
+def registrable_part(domain: str) -> str:
+    # Last two labels; close enough to the registrable domain to keep a site's hosts on one shard.
+    return domain[domain.rfind(".", 0, domain.rfind(".")) + 1:]
+
+_worker_index: "RelevanceIndex | None" = None
+
+def _init_relevance_worker(index_path: str) -> None:
+    global _worker_index
+    _worker_index = RelevanceIndex(index_path)
+
+def _filter_shard(shard: str) -> tuple[str, int]:
+    # Shards travel as one newline-joined string each way; pickling that is far cheaper than a list of str.
+    domains = shard.split("\n")
+    kept = [d for d in domains if _worker_index.contains_suffix(relevance_key(d))]
+    return "\n".join(kept), len(domains) - len(kept)
 
 class RelevanceChecker:
-    def __init__(self, session: requests.Session):
-        self.master_allowlist: set[str] = set()
+    def __init__(self, session: requests.Session, data_dir: str = None, processes: int = None):
+        self.index: RelevanceIndex | None = None
         self.session = session
+        self.dataset = RelevanceDataset(data_dir or os.path.join(Config.CACHE_DIR, "relevance"))
+        self.index_path = self.dataset.index_path
+        self.processes = processes if processes is not None else (Config.RELEVANCE_PROCESSES or os.cpu_count() or 1)
+        self._pool: concurrent.futures.ProcessPoolExecutor | None = None
+        self._pool_lock = threading.Lock()
 
     def build_dataset(self, max_workers: int = 5) -> None:
-        logger.info(f"Building relevance dataset using {max_workers} threads...")
-        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-            futures = [executor.submit(fetch_top_list, url, col, skip, comp, self.session) for url, col, skip, comp in TOP_LISTS]
-            for future in concurrent.futures.as_completed(futures):
-                self.master_allowlist.update(future.result())
-        logger.info(f"Relevance dataset built. Total unique root domains: {len(self.master_allowlist):,}")
+        start = time.perf_counter()
+        index = self.dataset.refresh(self.session, max_workers)
+        if self.index is not None: self.index.close()
+        self.index = index
+        logger.info(f"Relevance index ready: {len(self.index):,} domains ({time.perf_counter() - start:.2f}s)")
 
     def is_relevant(self, domain: str) -> bool:
-        clean_domain = domain.lower().strip('.')
-        if clean_domain.startswith("www."): clean_domain = clean_domain[4:]
-        return has_suffix_match(clean_domain, self.master_allowlist)
+        return self.index.contains_suffix(relevance_key(domain))
+
+    def rank(self, domain: str) -> int:
+        return self.index.best_rank(relevance_key(domain))
+
+    def _process_pool(self) -> concurrent.futures.ProcessPoolExecutor:
+        # Workers mmap the same index file, so the table is shared through the page cache rather than copied.
+        with self._pool_lock:
+            if self._pool is None:
+                logger.info(f"Starting {self.processes} relevance worker processes...")
+                self._pool = concurrent.futures.ProcessPoolExecutor(
+                    self.processes, mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_init_relevance_worker, initargs=(self.index_path,),
+                )
+            return self._pool
+
+    def filter(self, domains) -> tuple[set[str], int]:
+        if self.processes <= 1 or len(domains) < Config.RELEVANCE_SHARD_MIN:
+            kept = {d for d in domains if self.is_relevant(d)}
+            return kept, len(domains) - len(kept)
 
-def is_valid_domain(domain: str) -> str | None:
-    domain = domain.strip().strip(".")
-    if not domain or any(c in domain for c in "*/[]") or "." not in domain or IP_PATTERN.match(domain):
-        return None
-    return domain
+        shard_count = self.processes * 4
+        shards = [[] for _ in range(shard_count)]
+        for d in domains: shards[hash(registrable_part(d)) % shard_count].append(d)
+        pool = self._process_pool()
+        kept, pruned = set(), 0
+        for kept_text, shard_pruned in pool.map(_filter_shard, ("\n".join(shard) for shard in shards if shard)):
+            if kept_text: kept.update(kept_text.split("\n"))
+            pruned += shard_pruned
+        return kept, pruned
 
-def fetch_url(session: requests.Session, name: str, url: str | list[str], checker: RelevanceChecker = None):
+    def close(self) -> None:
+        if self._pool is not None: self._pool.shutdown()
+        self._pool = None
+
+class BlocklistParseError(RuntimeError):
+    pass
+
+def _content_lines(text: str) -> int:
+    return sum(1 for line in map(str.strip, text.splitlines()) if line and not line.startswith(("#", "!", "[")))
+
+def detect_format(sample: str) -> str:
+    best, best_hits = "plain", -1
+    for fmt, pattern in BLOCKLIST_FORMATS.items():
+        hits = sum(1 for _ in pattern.finditer(sample))
+        if hits > best_hits: best, best_hits = fmt, hits
+    return best
+
+def parse_blocklist(resp: requests.Response) -> set[str]:
+    # The format is picked once FORMAT_SAMPLE_LINES real entries are buffered, so a first chunk holding only
+    # a header or comments can't settle it.
+    domains, pattern, tail, pending, sampled, received = set(), None, b"", "", 0, 0
+    for chunk in resp.iter_content(chunk_size=PARSE_CHUNK_SIZE):
+        received += len(chunk)
+        buf = tail + chunk
+        cut = buf.rfind(b"\n") + 1
+        if not cut:
+            tail = buf
+            continue
+        tail = buf[cut:]
+        text = buf[:cut].decode("utf-8", "ignore").lower()
+        if pattern is None:
+            pending += text
+            sampled += _content_lines(text)
+            if sampled < FORMAT_SAMPLE_LINES: continue
+            text, pending = pending, ""
+            fmt = detect_format(text)
+            logger.info(f"Parsing {resp.url} as {fmt} format")
+            pattern = BLOCKLIST_FORMATS[fmt]
+        domains.update(pattern.findall(text))
+    text = pending + tail.decode("utf-8", "ignore").lower()
+    if pattern is None: pattern = BLOCKLIST_FORMATS[detect_format(text)]
+    domains.update(pattern.findall(text))
+    if not domains and received:
+        raise BlocklistParseError(f"No domains recognised in {received:,} bytes from {resp.url}")
+    return domains
+
+def fetch_url(session: requests.Session, name: str, url: str | list[str], checker: RelevanceChecker = None, cache: SourceCache = None):
     kept_domains = set()
     total_irrelevant_count = 0
     
@@ -269,20 +1106,18 @@ def fetch_url(session: requests.Session, name: str, url: str | list[str], checke
 
     for target_url in urls_to_process:
         try:
-            resp = session.get(target_url, timeout=Config.REQUEST_TIMEOUT)
-            resp.raise_for_status()
+            fetch_start = time.perf_counter()
+            domains, changed = fetch_source(session, target_url, parse_blocklist, "blocklist-v3", cache, timeout=Config.REQUEST_TIMEOUT)
+            metrics.record_source(name, kind="blocklist", bytes=metrics.downloaded(target_url), seconds=round(time.perf_counter() - fetch_start, 4), parsed=len(domains), not_modified=int(not changed))
             
-            skip_relevance = (name == "HaGeZi Normal") #False
-
-            for line in resp.text.splitlines():
-                line = line.strip()
-                if not line or line[0] in ("#", "!", "/"): continue
-                cleaned = is_valid_domain(line.split()[-1].lower())
-                if cleaned: 
-                    if checker and not skip_relevance and not checker.is_relevant(cleaned): 
-                        total_irrelevant_count += 1
-                    else: 
-                        kept_domains.add(cleaned)
+            skip_relevance = name in RELEVANCE_EXEMPT
+
+            if checker and not skip_relevance:
+                relevant, pruned = checker.filter(domains)
+                kept_domains |= relevant
+                total_irrelevant_count += pruned
+            else:
+                kept_domains |= domains
         except Exception as exc:
             logger.error(f"Error fetching submodule in {name} ({target_url}): {exc}")
             raise exc
@@ -290,20 +1125,22 @@ def fetch_url(session: requests.Session, name: str, url: str | list[str], checke
     logger.info(f"Fetched {name}: {len(kept_domains):,} kept (Pruned via relevance: {total_irrelevant_count:,})")
     return name, kept_domains, total_irrelevant_count
 
-def fetch_raw_tlds(session: requests.Session) -> list[str]:
-    logger.info("Fetching target Spam TLD source dataset...")
+def parse_tld_list(resp: requests.Response) -> list[str]:
     tlds = []
+    for line in resp.text.splitlines():
+        line = line.strip().lower()
+        if not line or line.startswith(("#", "!", "/")): continue
+        clean_tld = line.split()[-1].strip(".")
+        if clean_tld and "." not in clean_tld and "*" not in clean_tld:
+            tlds.append(clean_tld)
+    return sorted(list(set(tlds)))
+
+def fetch_raw_tlds(session: requests.Session, cache: SourceCache = None) -> list[str]:
+    logger.info("Fetching target Spam TLD source dataset...")
     try:
-        resp = session.get(SPAM_TLD_URL, timeout=Config.REQUEST_TIMEOUT)
-        resp.raise_for_status()
-        for line in resp.text.splitlines():
-            line = line.strip().lower()
-            if not line or line.startswith(("#", "!", "/")): continue
-            clean_tld = line.split()[-1].strip(".")
-            if clean_tld and "." not in clean_tld and "*" not in clean_tld:
-                tlds.append(clean_tld)
+        tlds, _ = fetch_source(session, SPAM_TLD_URL, parse_tld_list, "tld-v1", cache, timeout=Config.REQUEST_TIMEOUT)
         logger.info(f"Compiled {len(tlds):,} raw target entries from TLD blocklist.")
-        return sorted(list(set(tlds)))
+        return tlds
     except Exception as exc:
         logger.error(f"Failed to fetch baseline TLD requirements: {exc}")
         return []
@@ -312,83 +1149,398 @@ def build_cloudflare_tld_expression(tlds: list[str]) -> str:
     if not tlds: return ""
     return rf'any(dns.domains[*] matches "(?i)\.({"|".join(tlds)})$")'
 
+# Labels never contain a dot, so it can't collide with a child key.
+_END = "."
+_LEAF = types.MappingProxyType({_END: True})
+
+class DomainTrie:
+    # Nested dicts keyed by reversed labels; childless terminals share the read-only _LEAF node.
+    __slots__ = ("root",)
+
+    def __init__(self, domains=()):
+        self.root = {}
+        self.update(domains)
+
+    def update(self, domains) -> None:
+        root = self.root
+        for domain in domains:
+            node = root
+            labels = domain.split(".")
+            for i in range(len(labels) - 1, 0, -1):
+                child = node.get(labels[i])
+                if child is None:
+                    child = node[labels[i]] = {}
+                elif child is _LEAF:
+                    child = node[labels[i]] = {_END: True}
+                node = child
+            child = node.get(labels[0])
+            if child is None: node[labels[0]] = _LEAF
+            elif child is not _LEAF: child[_END] = True
+
+    def subtract(self, other: "DomainTrie") -> None:
+        stack = [(self.root, other.root)]
+        while stack:
+            node, theirs = stack.pop()
+            for label in [k for k in node if k != _END and k in theirs]:
+                their_child = theirs[label]
+                if _END in their_child:
+                    del node[label]
+                elif node[label] is not _LEAF:
+                    stack.append((node[label], their_child))
+
+    def pruned(self) -> list[str]:
+        out, stack = [], [(self.root, "")]
+        while stack:
+            node, name = stack.pop()
+            if _END in node:
+                out.append(name)
+                continue
+            children = sorted((k for k in node if k != _END), reverse=True)
+            stack.extend((node[label], f"{label}.{name}" if name else label) for label in children)
+        return out
+
 def optimize_domains(domains: set[str]) -> list[str]:
-    sorted_domains = sorted(domains, key=lambda d: d.split('.')[::-1])
-    optimized, last_kept = [], None
-    for dom in sorted_domains:
-        if last_kept and dom.endswith("." + last_kept): continue
-        optimized.append(dom)
-        last_kept = dom
-    return optimized
-
-def build_policy_sets(policies_config, fetched_lists):
-    sets = []
-    base_household_set = fetched_lists.get("HaGeZi Normal", set())
+    return DomainTrie(domains).pruned()
+
+def _is_public_suffix_like(suffix: str) -> bool:
+    labels = suffix.split(".")
+    if len(labels) < 2: return True
+    if len(labels) == 2 and labels[0] in _SECOND_LEVEL_LABELS and len(labels[1]) == 2: return True
+    return any(".".join(labels[i:]) in COLLAPSE_GUARD_SUFFIXES for i in range(len(labels) - 1))
+
+def collapse_dense_subtrees(domains, rank, min_entries: int = None, max_chars: int = None) -> tuple[list[str], list[str]]:
+    # Unlisted parents with many listed descendants become one "*.parent" regex alternative. Parents that look
+    # like a public suffix, are guarded, are (under) a ranked popular domain, or have a ranked domain between
+    # them and a listed one are never collapsed: their unlisted siblings may be popular too.
+    min_entries = min_entries or Config.COLLAPSE_MIN_ENTRIES
+    max_chars = max_chars or Config.COLLAPSE_MAX_EXPR_CHARS
+    counts: dict[str, int] = {}
+    ranked_below: set[str] = set()
+    for d in domains:
+        pos = d.find(".")
+        # rank() covers ancestors, so for a parent that is not ranked itself this finds a ranked name below it.
+        ranked = pos != -1 and d.find(".", pos + 1) != -1 and rank(d)
+        while pos != -1 and d.find(".", pos + 1) != -1:
+            parent = d[pos + 1:]
+            counts[parent] = counts.get(parent, 0) + 1
+            if ranked: ranked_below.add(parent)
+            pos = d.find(".", pos + 1)
+
+    candidates = sorted(((n, parent) for parent, n in counts.items() if n >= min_entries), key=lambda c: (-c[0], -c[1].count(".")))
+    chosen, chosen_set = [], set()
+    budget = max_chars - len(build_suffix_expression(["x"])) + 2
+    for n, parent in candidates:
+        cost = len(parent) + parent.count(".") + 1
+        if cost > budget or _is_public_suffix_like(parent) or parent in ranked_below or rank(parent): continue
+        if any(parent.endswith("." + c) for c in chosen_set) or any(c.endswith("." + parent) for c in chosen_set): continue
+        chosen.append(parent)
+        chosen_set.add(parent)
+        budget -= cost
+
+    if not chosen: return list(domains), []
+    tails = tuple("." + c for c in chosen)
+    return [d for d in domains if not d.endswith(tails)], sorted(chosen)
+
+def build_suffix_expression(suffixes: list[str]) -> str:
+    # Same shape as the spam-TLD expression; labels are [a-z0-9_-], so dots are the only characters to escape.
+    if not suffixes: return ""
+    escaped = "|".join(s.replace(".", r"\.") for s in suffixes)
+    return rf'any(dns.domains[*] matches "(?i)\.({escaped})$")'
+
+def apply_suffix_collapse(compiled_policies, rank):
+    collapsed = []
+    for policy, domains in compiled_policies:
+        kept, suffixes = collapse_dense_subtrees(domains, rank)
+        if suffixes:
+            logger.info(f"{policy['prefix']}: collapsed {len(domains) - len(kept):,} entries into {len(suffixes)} suffix match(es)")
+            policy = {**policy, "collapse_expression": build_suffix_expression(suffixes)}
+        metrics.set_gauge("collapsed_entries", len(domains) - len(kept), policy=policy["prefix"])
+        collapsed.append((policy, kept))
+    return collapsed
+
+class DomainTable:
+    # Each unique domain stored once, mapped to a bitmask of the sources that listed it.
+    def __init__(self, sources):
+        self.bits = {name: 1 << i for i, name in enumerate(sources)}
+        self.masks: dict[str, int] = {}
+        self.pruned_by_source: dict[str, int] = {}
+        self.pruned = 0   # unique domains dropped by the last filter_relevance()
+
+    def __len__(self) -> int:
+        return len(self.masks)
+
+    def mask_of(self, names) -> int:
+        mask = 0
+        for name in names: mask |= self.bits.get(name, 0)
+        return mask
+
+    def add(self, source: str, domains) -> None:
+        bit, masks = self.bits[source], self.masks
+        for d in domains: masks[d] = masks.get(d, 0) | bit
+
+    def filter_relevance(self, checker: RelevanceChecker, exempt=()) -> int:
+        # One check per unique domain; an irrelevant domain keeps only its exempt-source bits.
+        exempt_mask = self.mask_of(exempt)
+        masks = self.masks
+        candidates = [d for d, m in masks.items() if m & ~exempt_mask]
+        relevant, pruned = checker.filter(candidates)
+        removed: dict[int, int] = {}
+        for d in candidates:
+            if d in relevant: continue
+            m = masks[d]
+            removed[m] = removed.get(m, 0) + 1
+            m &= exempt_mask
+            if m: masks[d] = m
+            else: del masks[d]
+        self.pruned_by_source = {name: sum(n for m, n in removed.items() if m & bit & ~exempt_mask) for name, bit in self.bits.items()}
+        self.pruned = pruned
+        return pruned
+
+    def replace(self, source: str, domains, checker: RelevanceChecker = None, exempt=()) -> tuple[int, int]:
+        # Re-point one source's bit at a fresh parse. Only domains the source doesn't already hold here go
+        # through the relevance check (entries pruned last time are checked again). Returns (added, removed).
+        bit, masks = self.bits[source], self.masks
+        current = {d for d, m in masks.items() if m & bit}
+        added = [d for d in domains if d not in current]
+        if checker and source not in exempt and added:
+            relevant, _ = checker.filter(added)
+            added = [d for d in added if d in relevant]
+        removed = [d for d in current if d not in domains]
+        for d in removed:
+            m = masks[d] & ~bit
+            if m: masks[d] = m
+            else: del masks[d]
+        for d in added: masks[d] = masks.get(d, 0) | bit
+        pruned = len(domains) - (len(current) - len(removed) + len(added))
+        self.pruned_by_source[source] = pruned
+        return len(added), len(removed)
+
+    def source_counts(self) -> dict[str, int]:
+        per_mask: dict[int, int] = {}
+        for m in self.masks.values(): per_mask[m] = per_mask.get(m, 0) + 1
+        return {name: sum(n for m, n in per_mask.items() if m & bit) for name, bit in self.bits.items()}
+
+    def select(self, predicates: list[tuple[int, int]]) -> list[list[str]]:
+        # Single pass: which (include, exclude) predicates match is decided once per distinct mask.
+        buckets = [[] for _ in predicates]
+        pairs = list(zip(predicates, buckets))
+        routes = {}
+        for domain, mask in self.masks.items():
+            targets = routes.get(mask)
+            if targets is None:
+                targets = routes[mask] = [bucket for (inc, exc), bucket in pairs if mask & inc and not mask & exc]
+            for bucket in targets: bucket.append(domain)
+        return buckets
+
+def build_policy_sets(policies_config, table: DomainTable):
+    household_bit = table.mask_of(["HaGeZi Normal"])
+    predicates, subtract_household = [], []
 
     for policy in policies_config:
-        p_set = set()
-        
-        for inc in policy.get("include", []):
-            if inc in fetched_lists:
-                p_set |= fetched_lists[inc]
-                
-        for exc in policy.get("exclude", []):
-            if exc in fetched_lists:
-                p_set -= fetched_lists[exc]
-        
-        if (
-            policy["prefix"] != "L_Normal" 
-            and "HaGeZi Normal" not in policy.get("include", [])
-            and "HaGeZi Normal" not in policy.get("exclude", []) 
-            and base_household_set
-        ):
-            p_set = {dom for dom in p_set if not has_suffix_match(dom, base_household_set)}
-
-        sets.append((policy, optimize_domains(p_set)))
+        include = table.mask_of(policy.get("include", []))
+        exclude = table.mask_of(policy.get("exclude", []))
+        # Exact household matches drop out via the mask; subdomains of them via the trie below.
+        subtract = policy["prefix"] != "L_Normal" and not (include | exclude) & household_bit
+        predicates.append((include, exclude | household_bit if subtract else exclude))
+        subtract_household.append(subtract)
+
+    sets = []
+    household_trie = None
+    for policy, subtract, domains in zip(policies_config, subtract_household, table.select(predicates)):
+        p_trie = DomainTrie(domains)
+        if subtract:
+            if household_trie is None: household_trie = DomainTrie(*table.select([(household_bit, 0)]))
+            p_trie.subtract(household_trie)
+        sets.append((policy, p_trie.pruned()))
     return sets
 
+def pool_prefix(policies) -> str:
+    return "L_" + "+".join(p["prefix"].removeprefix("L_") for p in policies)
+
+def build_list_pools(compiled_policies) -> list[tuple[str, list[str], tuple[int, ...]]]:
+    # Split the domain universe into disjoint membership classes (e.g. "Relaxed+Restrictive", "Restrictive"), so a
+    # domain shared by several policies is stored once. Returns (pool prefix, sorted domains, member policy indexes).
+    membership: dict[str, int] = {}
+    for idx, (_, domains) in enumerate(compiled_policies):
+        bit = 1 << idx
+        for d in domains: membership[d] = membership.get(d, 0) | bit
+    classes: dict[int, list[str]] = {}
+    for d, mask in membership.items(): classes.setdefault(mask, []).append(d)
+
+    pools = []
+    for mask in sorted(classes, key=lambda m: (-bin(m).count("1"), m)):
+        members = tuple(idx for idx in range(len(compiled_policies)) if mask >> idx & 1)
+        pools.append((pool_prefix([compiled_policies[idx][0] for idx in members]), sorted(classes[mask]), members))
+    return pools
+
+def fit_to_quota(compiled_policies, rank=None):
+    # Over budget: keep entries by policy weight (a shared entry takes its heaviest policy's), then popularity rank
+    # (unranked last), then name, until both TOTAL_QUOTA and the list count (each pool rounds up to whole lists) fit.
+    # Returns (fitted, dropped).
+    pools = build_list_pools(compiled_policies)
+    total = sum(len(domains) for _, domains, _ in pools)
+    lists_needed = sum(-(-len(domains) // Config.MAX_LIST_SIZE) for _, domains, _ in pools)
+    if total <= Config.TOTAL_QUOTA and lists_needed <= Config.MAX_LISTS:
+        return compiled_policies, {}
+    logger.warning(f"Total compiled payload matrix size ({total:,} across {lists_needed} lists) exceeds infrastructure limits. Fitting to quota by policy weight and popularity rank...")
+
+    unranked = 1 << 32
+    candidates = []
+    for pidx, (_, domains, members) in enumerate(pools):
+        weight = max(compiled_policies[idx][0].get("weight", 1) for idx in members)
+        candidates.extend((-weight, (rank(d) if rank else 0) or unranked, d, pidx) for d in domains)
+    candidates.sort()
+
+    keep = candidates[:Config.TOTAL_QUOTA]
+    counts = [0] * len(pools)
+    for *_, pidx in keep: counts[pidx] += 1
+    overflow = sum(-(-c // Config.MAX_LIST_SIZE) for c in counts) - Config.MAX_LISTS
+    while overflow > 0:
+        pidx = keep.pop()[3]
+        counts[pidx] -= 1
+        if counts[pidx] % Config.MAX_LIST_SIZE == 0: overflow -= 1
+
+    kept = {d for _, _, d, _ in keep}
+    dropped = {}
+    for _, r, d, pidx in candidates[len(keep):]:
+        for idx in pools[pidx][2]:
+            dropped.setdefault(compiled_policies[idx][0]["prefix"], []).append((d, 0 if r == unranked else r))
+    for prefix, entries in dropped.items():
+        ranked = [r for _, r in entries if r]
+        logger.warning(f"Quota: dropped {len(entries):,} entries from {prefix} ({len(ranked):,} ranked, best dropped rank {min(ranked) if ranked else '-'})")
+    return [(policy, [d for d in domains if d in kept]) for policy, domains in compiled_policies], dropped
+
 # ---------------------------------------------------------------------------
-# 4. Cloudflare Sync & Cleanup
+# 5. Cloudflare Sync & Cleanup
 # ---------------------------------------------------------------------------
-def sync_to_cloudflare(cf: CloudflareAPI, existing_lists: list[dict], existing_rules: list[dict], domains: list[str], policy: dict, raw_tld_expr: str = "") -> tuple[list[str], list[str]]:
-    if not domains and not raw_tld_expr and not policy.get("category_condition"): return [], []
-    
-    used_ids = []
-    if domains:
-        sorted_domains = sorted(domains)
-        chunks = [sorted_domains[i : i + Config.MAX_LIST_SIZE] for i in range(0, len(sorted_domains), Config.MAX_LIST_SIZE)]
-        policy_existing_lists = sorted([l for l in existing_lists if l["name"].startswith(policy["prefix"] + " ")], key=lambda x: x["name"])
-        
-        def process_chunk(idx: int, chunk: list[str]) -> str:
-            list_name = f"{policy['prefix']} {idx + 1:03d}"
-            chunk_hash = hashlib.sha256(",".join(chunk).encode('utf-8')).hexdigest()
-            items = [{"value": d} for d in chunk]
-            
-            if idx < len(policy_existing_lists):
-                existing = policy_existing_lists[idx]
-                if existing.get("description") == chunk_hash: return existing["id"]
-                cf.update_list(existing["id"], list_name, items, desc=chunk_hash)
-                logger.info(f"Updated list {list_name} ({len(chunk):,} domains)")
-                return existing["id"]
-            else:
-                res = cf.create_list(list_name, items, desc=chunk_hash)
-                logger.info(f"Created list {list_name} ({len(chunk):,} domains)")
-                return res["result"]["id"]
+def jump_hash(key: int, buckets: int) -> int:
+    # Lamping & Veach jump consistent hash: growing N -> N+1 buckets only moves 1/(N+1) of the keys.
+    b, j = -1, 0
+    while j < buckets:
+        b = j
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((b + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return b
+
+def plan_slot_count(domain_count: int, current_slots: int = 0) -> int:
+    if not domain_count: return 0
+    dense = -(-domain_count // Config.MAX_LIST_SIZE)
+    if dense <= current_slots and domain_count >= current_slots * Config.MAX_LIST_SIZE * Config.SLOT_MIN_FILL:
+        return current_slots
+    return max(dense, -(-domain_count // int(Config.MAX_LIST_SIZE * Config.SLOT_FILL_TARGET)))
+
+def generation_prefixes(prefix: str) -> tuple[str, str]:
+    return prefix, f"{prefix}.b"
+
+def live_generation(prefix: str, inventory: RemoteInventory) -> str:
+    referenced = {lid for r in inventory.all_rules() for lid in RULE_LIST_REF.findall(r["traffic"])}
+    candidates = []
+    for gen in generation_prefixes(prefix):
+        lists = inventory.lists_with_prefix(gen).values()
+        candidates.append((any(l["id"] in referenced for l in lists), len(lists), gen == prefix, gen))
+    return max(candidates)[3]
+
+def plan_slot_counts(pools, existing_lists: list[dict], live_prefixes: dict[str, str] = None) -> dict[str, int]:
+    counts = {}
+    for prefix, domains, _ in pools:
+        live = (live_prefixes or {}).get(prefix, prefix)
+        current = sum(1 for l in existing_lists if l["name"].startswith(live + " "))
+        counts[prefix] = plan_slot_count(len(domains), current)
+    if sum(counts.values()) > Config.MAX_LISTS:
+        logger.warning("Slot headroom would exceed the list quota. Falling back to densely packed lists.")
+        counts = {prefix: -(-len(domains) // Config.MAX_LIST_SIZE) for prefix, domains, _ in pools}
+    return counts
+
+def assign_slots(domains: list[str], slot_count: int) -> list[list[str]]:
+    buckets = [[] for _ in range(slot_count)]
+    for d in domains:
+        h = domain_hash(d.encode("utf-8"))
+        buckets[jump_hash(h, slot_count)].append((h, d))
 
-        with concurrent.futures.ThreadPoolExecutor(max_workers=Config.MAX_WORKERS) as executor:
-            futures = [executor.submit(process_chunk, idx, chunk) for idx, chunk in enumerate(chunks)]
-            used_ids = [f.result() for f in futures]
+    spill = []
+    for bucket in buckets:
+        if len(bucket) > Config.MAX_LIST_SIZE:
+            bucket.sort()
+            spill.extend(bucket[Config.MAX_LIST_SIZE:])
+            del bucket[Config.MAX_LIST_SIZE:]
+    spill.sort()
+    for bucket in buckets:
+        if not spill: break
+        room = Config.MAX_LIST_SIZE - len(bucket)
+        if room > 0:
+            bucket.extend(spill[:room])
+            del spill[:room]
+    return [sorted(d for _, d in bucket) for bucket in buckets]
 
-    list_items = [f"any(dns.domains[*] in ${lid})" for lid in used_ids]
+class ListSnapshotStore:
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, lid: str) -> str:
+        return os.path.join(self.root, f"{lid}.txt")
+
+    def load(self, lid: str, description: str, stamp: str = None) -> tuple[list[str] | None, str | None]:
+        # The list's items and content hash, as far as our last write can vouch for them. A PATCH leaves the
+        # description naming older content, so once the list's updated_at moves past the stamp of that write,
+        # neither the snapshot nor the description says what the list holds.
+        try:
+            with open(self._path(lid), encoding="utf-8") as f: items = f.read().split("\n")
+        except OSError:
+            return None, description
+        saved_stamp = items.pop(0)[1:] if items and items[0].startswith("@") else None
+        items = [d for d in items if d]
+        digest = hashlib.sha256(",".join(items).encode("utf-8")).hexdigest()
+        if saved_stamp is not None: return (items, digest) if saved_stamp == stamp else (None, None)
+        return (items, digest) if digest == description else (None, description)
+
+    def save(self, lid: str, items: list[str], stamp: str = None) -> None:
+        tmp = f"{self._path(lid)}.tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f: f.write("\n".join([f"@{stamp}", *items] if stamp else items))
+            os.replace(tmp, self._path(lid))
+        except OSError as exc:
+            logger.warning(f"Could not persist snapshot for list {lid}: {exc}")
+
+    def retain(self, active_ids) -> None:
+        keep = {f"{lid}.txt" for lid in active_ids}
+        for fname in os.listdir(self.root):
+            if fname.endswith(".txt") and fname not in keep:
+                os.unlink(os.path.join(self.root, fname))
+
+RULE_LIST_REF = re.compile(r"\$([0-9A-Za-z-]+)")
+
+def is_managed_rule(name: str) -> bool:
+    if any(kw in name for kw in ["IoT Bypass", "Custom", "Keywords"]): return False
+    return any(target in name for target in Config.SCRUB_TARGETS)
+
+def is_managed_list(name: str) -> bool:
+    return "IoT Bypass" not in name and any(target in name for target in Config.SCRUB_TARGETS)
+
+def shard_rule_name(policy: dict, prefix: str, group: int) -> str:
+    # Shards are keyed by list pool and slot group, so a pool growing or a blue/green swap only touches its own shards.
+    return f"{policy['policy_name']} [{prefix} #{group + 1}]"
+
+def shard_precedence(inventory: RemoteInventory, policy: dict, band: int) -> int | None:
+    # Shards sit in a precedence band right after their policy's head rule; without one they keep their own.
+    head = inventory.rule_named(policy["policy_name"])
+    return head["precedence"] + 1 + band if head and head.get("precedence") is not None else None
+
+def build_rule_payload(policy: dict, list_ids: list[str], raw_tld_expr: str = "", enabled: bool = True, name: str = None, extras: bool = True, precedence: int = None) -> dict:
+    # extras=False builds a rule shard: list references only, the policy's other terms stay on its head rule.
+    list_items = [f"any(dns.domains[*] in ${lid})" for lid in list_ids]
     
     if raw_tld_expr and policy.get("use_spam_tld", False):
         list_items.append(f"({raw_tld_expr})")
         
-    if policy["prefix"] == "L_Restrictive":
+    if extras and policy["prefix"] == "L_Restrictive":
         list_items.append(ADULT_KEYWORDS_EXPR)
+
+    if extras and policy.get("collapse_expression"):
+        list_items.append(policy["collapse_expression"])
         
     cat_expr = policy.get("category_condition")
-    if cat_expr:
+    if extras and cat_expr:
         list_items.append(f"({cat_expr})")
 
     traffic_expr, identity_expr = "", ""
@@ -403,200 +1555,815 @@ def sync_to_cloudflare(cf: CloudflareAPI, existing_lists: list[dict], existing_r
     else:
         traffic_expr = " or ".join(list_items)
 
-    final_rule_name = policy['policy_name']
-    action = policy.get("action", "block")
-    existing_rule = next((r for r in existing_rules if r["name"] == final_rule_name), None)
-    is_enabled = existing_rule.get("enabled", True) if existing_rule else True
-
-    payload = {"name": final_rule_name, "action": action, "enabled": is_enabled, "filters": ["dns"], "traffic": traffic_expr}
+    payload = {"name": name or policy["policy_name"], "action": policy.get("action", "block"), "enabled": enabled, "filters": ["dns"], "traffic": traffic_expr}
     if identity_expr: payload["identity"] = identity_expr
-    
-    if existing_rule:
-        if existing_rule.get("traffic", "") == traffic_expr and existing_rule.get("identity", "") == identity_expr:
-            logger.info(f"Firewall rule {final_rule_name} unchanged. Skipping.")
+    if precedence is not None: payload["precedence"] = precedence
+    return payload
+
+def detached_rule_payload(policy: dict, enabled: bool = True, name: str = None, extras: bool = True) -> dict:
+    cat_expr = policy.get("category_condition") if extras else None
+    fallback_items = [f"({cat_expr})"] if cat_expr else []
+    if cat_expr and policy["prefix"] == "L_Restrictive": fallback_items.append(ADULT_KEYWORDS_EXPR)
+    if extras and policy.get("collapse_expression"): fallback_items.append(policy["collapse_expression"])
+    fallback_traffic = " or ".join(fallback_items) or 'dns.domains == "detached.placeholder"'
+    payload = {"name": name or policy["policy_name"], "action": policy.get("action", "block"), "enabled": enabled, "filters": ["dns"], "traffic": fallback_traffic}
+    cond = policy.get("identity_condition")
+    if cond and "dns." not in cond:
+        payload["identity"] = cond
+    return payload
+
+class SyncPlan:
+    # Ops run phase by phase; ops inside a phase are independent and run concurrently.
+    PHASES = (
+        ("delete_rule",),
+        ("detach_rule",),
+        ("release_list",),
+        ("create_list", "put_list", "patch_list"),
+        ("create_rule", "update_rule"),
+        ("create_shard", "update_shard"),   # after the head rules, whose precedence they are placed by
+        ("retire_rule",),
+        ("delete_list",),
+    )
+
+    def __init__(self):
+        self.ops: list[dict] = []
+        self.snapshot_fills: list[tuple[str, list[str], str | None]] = []
+        self.list_names: list[str] = []
+
+    def __bool__(self) -> bool:
+        return bool(self.ops)
+
+    def add(self, op: str, **fields) -> None:
+        self.ops.append({"op": op, **fields})
+
+    def of(self, *kinds: str) -> list[dict]:
+        return [op for op in self.ops if op["op"] in kinds]
+
+    def counts(self) -> dict[str, int]:
+        counts = {}
+        for op in self.ops: counts[op["op"]] = counts.get(op["op"], 0) + 1
+        return counts
+
+    def api_calls(self) -> int:
+        return len(self.ops)
+
+    def summary(self) -> str:
+        if not self.ops: return "no changes"
+        parts = [f"{count} {kind}" for phase in self.PHASES for kind in phase if (count := self.counts().get(kind))]
+        return f"{', '.join(parts)} (~{self.api_calls()} API calls)"
+
+def build_sync_plan(compiled_policies, inventory: RemoteInventory, tld_regex_expression: str = "", snapshots: ListSnapshotStore = None) -> SyncPlan:
+    plan = SyncPlan()
+    pools = build_list_pools(compiled_policies)
+    live_prefixes = {prefix: live_generation(prefix, inventory) for prefix, _, _ in pools}
+    slot_counts = plan_slot_counts(pools, inventory.all_lists(), live_prefixes)
+    swap_budget = Config.MAX_LISTS - len(inventory.lists)
+
+    known = {}
+    def remote_content(lst: dict) -> tuple[list[str] | None, str | None]:
+        if lst["id"] not in known:
+            known[lst["id"]] = snapshots.load(lst["id"], lst.get("description"), lst.get("updated_at")) if snapshots else (None, lst.get("description"))
+        return known[lst["id"]]
+
+    desired_rules = {}
+    desired_lists = {}
+    pool_lists = [[] for _ in compiled_policies]
+    for prefix, domains, members in pools:
+        live = live_prefixes[prefix]
+        chunks = assign_slots(domains, slot_counts[prefix])
+        target = live
+        if Config.ROLLOUT_MODE == "bluegreen":
+            live_lists = inventory.lists_with_prefix(live)
+            changed = sum(
+                1 for idx, chunk in enumerate(chunks)
+                if f"{live} {idx + 1:03d}" not in live_lists
+                or remote_content(live_lists[f"{live} {idx + 1:03d}"])[1] != hashlib.sha256(",".join(chunk).encode('utf-8')).hexdigest()
+            )
+            resized = len(chunks) != len(live_lists)
+            if live_lists and changed and (resized or changed >= Config.BLUEGREEN_MIN_CHANGED * len(chunks)):
+                standby = next(gen for gen in generation_prefixes(prefix) if gen != live)
+                leftovers = len(inventory.lists_with_prefix(standby))
+                if swap_budget + leftovers >= len(chunks):
+                    swap_budget -= len(chunks) - leftovers
+                    target = standby
+                    logger.info(f"Blue/green: writing {len(chunks)} lists for {prefix} under {standby} ({changed} changed, resized={resized})")
+                else:
+                    logger.warning(f"Blue/green: not enough list quota to stage {prefix}. Updating in place.")
+        names = [f"{target} {idx + 1:03d}" for idx in range(len(chunks))]
+        desired_lists.update(zip(names, chunks))
+        for member in members: pool_lists[member].append((prefix, names))
+    shard = Config.RULE_SHARD_LISTS
+    for (policy, _), groups in zip(compiled_policies, pool_lists):
+        tld_expr = tld_regex_expression if policy.get("use_spam_tld", False) else ""
+        names = [n for _, group in groups for n in group]
+        has_terms = tld_expr or policy.get("category_condition") or policy.get("collapse_expression") or (names and policy["prefix"] == "L_Restrictive")
+        head = inventory.rule_named(policy["policy_name"])
+        enabled = head.get("enabled") is not False if head else None
+        if shard:
+            # Shards follow the head rule's on/off state. Their precedence band offset depends only on the pool
+            # and group, so other pools growing doesn't renumber a shard.
+            stride = -(-Config.MAX_LISTS // shard)
+            for pool_idx, (prefix, group) in enumerate(groups):
+                for start in range(0, len(group), shard):
+                    desired_rules[shard_rule_name(policy, prefix, start // shard)] = (policy, group[start:start + shard], "", False, enabled, pool_idx * stride + start // shard)
+            names = []
+        if names or has_terms:
+            desired_rules[policy["policy_name"]] = (policy, names, tld_expr, True, enabled, None)
+    plan.list_names = list(desired_lists)
+
+    keep_ids, created = set(), set()
+    for name, chunk in desired_lists.items():
+        chunk_hash = hashlib.sha256(",".join(chunk).encode('utf-8')).hexdigest()
+        existing = inventory.list_named(name)
+        if not existing:
+            plan.add("create_list", name=name, items=chunk, hash=chunk_hash)
+            created.add(name)
+            continue
+        lid = existing["id"]
+        keep_ids.add(lid)
+        # A count that disagrees with the content its hash stands for means the list was edited outside the sync.
+        previous, digest = remote_content(existing)
+        if digest == chunk_hash and existing.get("count") in (None, len(chunk)):
+            if snapshots and previous is None: plan.snapshot_fills.append((lid, chunk, existing.get("updated_at")))
+            continue
+        if previous is not None and existing.get("count") in (None, len(previous)):
+            current, before = set(chunk), set(previous)
+            added = [d for d in chunk if d not in before]
+            removed = [d for d in previous if d not in current]
+            if len(added) + len(removed) <= len(chunk):
+                plan.add("patch_list", list_id=lid, name=name, items=chunk, hash=chunk_hash, append=added, remove=removed)
+                continue
+        plan.add("put_list", list_id=lid, name=name, items=chunk, hash=chunk_hash)
+
+    deleted_rule_ids, retiring = set(), {}
+    live_policies = tuple(f"{policy['policy_name']} [" for policy, _ in compiled_policies)
+    live_heads = {policy["policy_name"] for policy, _ in compiled_policies}
+    for rule in inventory.all_rules():
+        if rule["name"] not in desired_rules and is_managed_rule(rule["name"]):
+            if rule["name"] in live_heads or rule["name"].startswith(live_policies):
+                # Stale head or shard of a policy that stays: dropped only once its replacement rules are in place.
+                plan.add("retire_rule", rule_id=rule["id"], name=rule["name"])
+                retiring[rule["id"]] = plan.ops[-1]
+                continue
+            plan.add("delete_rule", rule_id=rule["id"], name=rule["name"])
+            deleted_rule_ids.add(rule["id"])
+
+    for rule_name, (policy, names, tld_expr, extras, enabled, band) in desired_rules.items():
+        existing = inventory.rule_named(rule_name)
+        create, update = ("create_rule", "update_rule") if band is None else ("create_shard", "update_shard")
+        fields = dict(policy=policy, lists=names, tld_expr=tld_expr, extras=extras, enabled=enabled, band=band)
+        if not existing:
+            plan.add(create, name=rule_name, **fields)
+            continue
+        # A head rule created in this run has no precedence yet, so its existing shards are placed again.
+        head_pending = band is not None and policy["policy_name"] in desired_rules and not inventory.rule_named(policy["policy_name"])
+        if not created.intersection(names) and not head_pending:
+            payload = build_rule_payload(policy, [inventory.list_named(n)["id"] for n in names], tld_expr, name=rule_name, extras=extras)
+            if (
+                existing["traffic"] == payload["traffic"] and existing["identity"] == payload.get("identity", "")
+                and enabled in (None, existing.get("enabled") is not False)
+                and (band is None or shard_precedence(inventory, policy, band) in (None, existing.get("precedence")))
+            ): continue
+        plan.add(update, rule_id=existing["id"], name=rule_name, **fields)
+
+    holders = {}
+    for rule in inventory.all_rules():
+        if rule["id"] in deleted_rule_ids: continue
+        for lid in RULE_LIST_REF.findall(rule["traffic"]): holders.setdefault(lid, []).append(rule)
+
+    release, retire = [], []
+    for lst in inventory.all_lists():
+        if lst["id"] in keep_ids or not is_managed_list(lst["name"]): continue
+        rules = holders.get(lst["id"], [])
+        if not rules: release.append(lst)
+        elif all(r["name"] in desired_rules or r["id"] in retiring for r in rules): retire.append(lst)
+        else: logger.warning(f"Stale list {lst['name']} is still referenced by an unmanaged rule. Leaving it in place.")
+
+    available = Config.MAX_LISTS - (len(inventory.lists) - len(release))
+    if len(created) > available and retire:
+        logger.warning(f"Creating {len(created)} lists needs quota held by {len(retire)} stale lists. Detaching their rules first.")
+        detach = {r["id"]: r for l in retire for r in holders[l["id"]]}
+        for rule in detach.values():
+            if rule["id"] in retiring:
+                retiring[rule["id"]]["op"] = "delete_rule"
+                continue
+            policy, _, _, extras, _, _ = desired_rules[rule["name"]]
+            plan.add("detach_rule", rule_id=rule["id"], name=rule["name"], policy=policy, extras=extras)
+        release.extend(retire)
+        retire = []
+
+    for lst in release: plan.add("release_list", list_id=lst["id"], name=lst["name"])
+    for lst in retire: plan.add("delete_list", list_id=lst["id"], name=lst["name"])
+
+    order = {kind: i for i, phase in enumerate(SyncPlan.PHASES) for kind in phase}
+    plan.ops.sort(key=lambda op: order[op["op"]])
+    return plan
+
+async def _apply_op(cf: CloudflareAPI, inventory: RemoteInventory, snapshots: ListSnapshotStore | None, op: dict) -> None:
+    kind, name = op["op"], op["name"]
+
+    if kind == "create_list":
+        res = await cf.create_list(name, [{"value": d} for d in op["items"]], desc=op["hash"])
+        lid = res["result"]["id"]
+        inventory.put_list({"id": lid, "name": name, "description": op["hash"], "count": len(op["items"]), "updated_at": res["result"].get("updated_at")})
+        if snapshots: snapshots.save(lid, op["items"], res["result"].get("updated_at"))
+        logger.info(f"Created list {name} ({len(op['items']):,} domains)")
+
+    elif kind == "put_list":
+        res = await cf.update_list(op["list_id"], name, [{"value": d} for d in op["items"]], desc=op["hash"])
+        inventory.put_list({"id": op["list_id"], "name": name, "description": op["hash"], "count": len(op["items"]), "updated_at": res["result"].get("updated_at")})
+        if snapshots: snapshots.save(op["list_id"], op["items"], res["result"].get("updated_at"))
+        logger.info(f"Updated list {name} ({len(op['items']):,} domains)")
+
+    elif kind == "patch_list":
+        res = await cf.patch_list(op["list_id"], op["append"], op["remove"])
+        desc = inventory.list_named(name)["description"]
+        if not res["result"].get("updated_at"):
+            # Without a stamp the snapshot can only be matched by hash, so the description has to follow.
+            res, desc = await cf.update_list_meta(op["list_id"], name, desc=op["hash"]), op["hash"]
+        snapshots.save(op["list_id"], op["items"], res["result"].get("updated_at"))
+        inventory.put_list({"id": op["list_id"], "name": name, "description": desc, "count": len(op["items"]), "updated_at": res["result"].get("updated_at")})
+        logger.info(f"Patched list {name} (+{len(op['append']):,} / -{len(op['remove']):,} domains)")
+
+    elif kind in ("create_rule", "update_rule", "create_shard", "update_shard"):
+        existing = inventory.rule_named(name)
+        enabled = op["enabled"] if op["enabled"] is not None else (existing.get("enabled") is not False if existing else True)
+        precedence = shard_precedence(inventory, op["policy"], op["band"]) if op["band"] is not None else None
+        payload = build_rule_payload(op["policy"], [inventory.list_named(n)["id"] for n in op["lists"]], op["tld_expr"], enabled, name, op["extras"], precedence)
+        if kind.startswith("create"):
+            res = await cf.create_rule(payload)
+            inventory.put_rule({**payload, "id": res["result"]["id"], "precedence": res["result"].get("precedence"), "updated_at": res["result"].get("updated_at")})
+            logger.info(f"Firewall rule created: {name}")
         else:
-            cf.update_rule(existing_rule["id"], payload)
-            logger.info(f"Firewall rule updated: {final_rule_name}")
-    else: 
-        cf.create_rule(payload)
-        logger.info(f"Firewall rule created: {final_rule_name}")
-            
-    return used_ids, [final_rule_name]
+            res = await cf.update_rule(op["rule_id"], payload)
+            inventory.put_rule({**inventory.rule_named(name), **payload, "updated_at": res["result"].get("updated_at")})
+            logger.info(f"Firewall rule updated: {name}")
 
-def cleanup_orphans(cf: CloudflareAPI, existing_lists: list[dict], existing_rules: list[dict], active_list_ids: list[str], active_rule_names: list[str]):
-    logger.info("Running post-sync cleanup of orphaned firewall rules...")
-    for r in existing_rules:
-        if any(kw in r["name"] for kw in ["IoT Bypass", "Custom", "Keywords"]): continue
-        if r["name"] not in active_rule_names and any(target in r["name"] for target in Config.SCRUB_TARGETS):
-            try:
-                cf.delete_rule(r["id"])
-                logger.info(f"Deleted Orphaned Rule: {r['name']}")
-            except Exception as e: logger.error(f"Could not delete rule {r['name']}: {e}")
+    elif kind == "detach_rule":
+        existing = inventory.rule_named(name) or {}
+        payload = detached_rule_payload(op["policy"], existing.get("enabled") is not False, name, op["extras"])
+        try:
+            res = await cf.update_rule(op["rule_id"], payload)
+            inventory.put_rule({**payload, "id": op["rule_id"], "updated_at": res["result"].get("updated_at")})
+            logger.info(f"Detached lists from firewall rule {name} to release quota")
+        except Exception as e:
+            logger.error(f"Failed to temporarily detach rule {name}: {e}")
 
-    for l in existing_lists:
-        if "IoT Bypass" in l["name"]: continue
-        if l["id"] not in active_list_ids and any(target in l["name"] for target in Config.SCRUB_TARGETS):
-            try:
-                cf.delete_list(l["id"])
-                logger.info(f"Deleted Orphaned List: {l['name']}")
-            except Exception as e: logger.error(f"Could not delete list {l['name']}: {e}")
+    elif kind in ("delete_rule", "retire_rule"):
+        try:
+            await cf.delete_rule(op["rule_id"])
+            inventory.drop_rule(op["rule_id"])
+            logger.info(f"Deleted Orphaned Rule: {name}")
+        except Exception as e: logger.error(f"Could not delete rule {name}: {e}")
+
+    elif kind in ("release_list", "delete_list"):
+        try:
+            await cf.delete_list(op["list_id"])
+            inventory.drop_list(op["list_id"])
+            logger.info(f"Deleted Orphaned List: {name}")
+        except Exception as e: logger.error(f"Could not delete list {name}: {e}")
+
+async def apply_sync_plan(cf: CloudflareAPI, inventory: RemoteInventory, plan: SyncPlan, snapshots: ListSnapshotStore = None) -> None:
+    if snapshots:
+        for lid, chunk, stamp in plan.snapshot_fills: snapshots.save(lid, chunk, stamp)
+    for phase in SyncPlan.PHASES:
+        ops = plan.of(*phase)
+        if ops: await asyncio.gather(*(_apply_op(cf, inventory, snapshots, op) for op in ops))
+
+class SyncSession:
+    # Cloudflare client plus the remote inventory it last saw, for one account. A cron run uses it once; the
+    # daemon keeps it and only re-verifies the inventory against the remote every INVENTORY_CHECK_INTERVAL seconds.
+    def __init__(self, account: dict = None):
+        self.account = account or {}
+        self.name = self.account.get("name")
+        self.cf = CloudflareAPI(self.account.get("account_id"), self.account.get("api_token"))
+        state_dir = os.path.join(Config.CACHE_DIR, "accounts", self.name) if self.name else Config.CACHE_DIR
+        self.manifest = SyncManifest(os.path.join(state_dir, "manifest.json"))
+        self.snapshots = ListSnapshotStore(os.path.join(state_dir, "lists"))
+        self.inventory: RemoteInventory | None = None
+        self.checked_at = 0.0
+
+    def _stage(self, stage: str):
+        return metrics.stage(f"{stage}:{self.name}" if self.name else stage)
+
+    async def sync(self, compiled_policies, tld_regex_expression: str = "", plan_only: bool = False) -> SyncPlan:
+        labels = {"account": self.name} if self.name else {}
+        if self.inventory is None or time.time() - self.checked_at >= Config.INVENTORY_CHECK_INTERVAL:
+            with self._stage("load_inventory"):
+                self.inventory = await self.manifest.load_inventory(self.cf)
+            self.checked_at = time.time()
+        inventory, snapshots = self.inventory, self.snapshots
+
+        try:
+            with self._stage("plan"):
+                plan = build_sync_plan(compiled_policies, inventory, tld_regex_expression, snapshots)
+            logger.info(f"Sync plan{f' [{self.name}]' if self.name else ''}: {plan.summary()}")
+            for kind, count in plan.counts().items(): metrics.set_gauge("plan_operations", count, kind=kind, **labels)
+            metrics.set_gauge("plan_api_calls", plan.api_calls(), **labels)
+            if plan_only: return plan
+
+            if plan:
+                self.manifest.invalidate()
+                with self._stage("apply"):
+                    await apply_sync_plan(self.cf, inventory, plan, snapshots)
+            else:
+                logger.info(f"Remote state{f' of {self.name}' if self.name else ''} already matches compiled policies. Skipping all writes.")
+                for lid, chunk, stamp in plan.snapshot_fills: snapshots.save(lid, chunk, stamp)
+
+            snapshots.retain(inventory.list_named(n)["id"] for n in plan.list_names)
+            self.manifest.save(inventory)
+            return plan
+        except BaseException:
+            self.inventory = None   # a failed apply leaves the remote state unknown; crawl again next time
+            raise
+
+    def close(self) -> None:
+        self.cf.close()
+
+def load_accounts() -> list[dict]:
+    # ACCOUNTS_JSON (or the JSON file named by ACCOUNTS_FILE) is a list of
+    # {"name", "account_id", "api_token" | "api_token_env", "excluded_emails"?, "policies"?}; "policies" lists the
+    # prefixes or names enabled for that account (default: all). Without it, the single API_TOKEN/ACCOUNT_ID account is used.
+    raw = Config.ACCOUNTS_JSON
+    if not raw and Config.ACCOUNTS_FILE:
+        with open(Config.ACCOUNTS_FILE, encoding="utf-8") as f: raw = f.read()
+    if not raw: return [{}]
+
+    entries = json.loads(raw)
+    if not isinstance(entries, list): raise EnvironmentError("The accounts configuration must be a JSON list")
+    accounts, seen = [], set()
+    for entry in entries:
+        name = entry.get("name", "")
+        token = entry.get("api_token") or os.environ.get(entry.get("api_token_env", ""), "")
+        if not re.fullmatch(r"[A-Za-z0-9_.-]+", name) or name in seen:
+            raise EnvironmentError(f"Account names must be unique and use only letters, digits, '.', '_' or '-': {name!r}")
+        if not entry.get("account_id") or not token:
+            raise EnvironmentError(f"Account {name} needs an account_id and an api_token (or api_token_env)")
+        seen.add(name)
+        accounts.append({**entry, "api_token": token})
+    return accounts
+
+def account_policies(compiled_policies, account: dict) -> list:
+    enabled = account.get("policies")
+    selected = []
+    for policy, domains in compiled_policies:
+        if enabled is not None and policy["prefix"] not in enabled and policy["policy_name"] not in enabled: continue
+        if "excluded_emails" in account and policy.get("account_identity"):
+            policy = {**policy, "identity_condition": excluded_identity(account["excluded_emails"])}
+        selected.append((policy, domains))
+    return selected
+
+async def sync_accounts(syncers: list[SyncSession], compiled_policies, tld_regex_expression: str = "", plan_only: bool = False) -> list:
+    # Every account syncs concurrently with its own client and rate limiter; one account failing leaves the others alone.
+    results = await asyncio.gather(
+        *(s.sync(account_policies(compiled_policies, s.account), tld_regex_expression, plan_only) for s in syncers),
+        return_exceptions=True,
+    )
+    for syncer, result in zip(syncers, results):
+        failed = isinstance(result, BaseException)
+        if failed and len(syncers) > 1:
+            logger.error(f"Sync failed for account {syncer.name}: {result}", exc_info=result)
+        if syncer.name: metrics.set_gauge("account_sync_success", int(not failed), account=syncer.name)
+    return results
+
+async def sync_to_cloudflare(compiled_policies, tld_regex_expression: str = "", plan_only: bool = False, accounts: list[dict] = None) -> list:
+    syncers = [SyncSession(account) for account in accounts or [{}]]
+    try:
+        return await sync_accounts(syncers, compiled_policies, tld_regex_expression, plan_only)
+    finally:
+        for syncer in syncers: syncer.close()
 
 # ---------------------------------------------------------------------------
-# 5. Main Execution
+# 6. Main Execution
 # ---------------------------------------------------------------------------
-def main() -> None:
+def write_quota_report(dropped) -> None:
+    path = os.path.join(Config.METRICS_DIR, "quota_dropped.tsv")
+    try:
+        os.makedirs(Config.METRICS_DIR, exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("policy\tdomain\trank\n")
+            for prefix, entries in dropped.items():
+                for domain, r in entries: f.write(f"{prefix}\t{domain}\t{r or ''}\n")
+        if dropped: logger.info(f"Dropped entries listed in {path}")
+    except OSError as e:
+        logger.warning(f"Could not write quota report: {e}")
+
+# format -> (file name, line template, compression, header)
+ARTIFACTS = {
+    "plain":      ("aggregate_blocklist.txt",          "{}\n",         None,   ""),
+    "gzip":       ("aggregate_blocklist.txt.gz",       "{}\n",         "gzip", ""),
+    "zstd":       ("aggregate_blocklist.txt.zst",      "{}\n",         "zstd", ""),
+    "hosts":      ("aggregate_blocklist.hosts",        "0.0.0.0 {}\n", None,   ""),
+    "abp":        ("aggregate_blocklist.abp.txt",      "||{}^\n",      None,   "[Adblock Plus]\n"),
+    "dnsmasq":    ("aggregate_blocklist.dnsmasq.conf", "local=/{}/\n", None,   ""),
+    "frontcoded": ("aggregate_blocklist.fc",           None,           None,   ""),
+}
+
+def _label_key(domain: str) -> list[str]:
+    return domain.split(".")[::-1]
+
+def merge_policy_domains(compiled_policies):
+    # DomainTrie.pruned() emits each policy in reversed-label order, so a k-way merge yields the
+    # deduplicated union without ever holding it in memory.
+    last = None
+    for domain in heapq.merge(*(domains for _, domains in compiled_policies), key=_label_key):
+        if domain != last:
+            yield domain
+            last = domain
+
+def _varint(n: int) -> bytes:
+    out = bytearray()
+    while n >= 0x80:
+        out.append(n & 0x7F | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+def _read_varint(data: bytes, pos: int) -> tuple[int, int]:
+    n = shift = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        n |= (b & 0x7F) << shift
+        if b < 0x80: return n, pos
+        shift += 7
+
+class FrontCodedWriter:
+    # Keys are the reversed labels joined by NUL ("com\0example\0ads"); NUL sorts below every label byte, so
+    # byte order matches label order and a reader can binary-search the restart points. Each entry is
+    # varint(shared prefix) varint(suffix length) suffix; every RESTART-th entry is stored whole and its offset
+    # indexed. Footer: <QQI count, index offset, RESTART + MAGIC.
+    MAGIC = b"BASFC02\n"
+    RESTART = 64
+    FOOTER = struct.Struct("<QQI")
+
+    def __init__(self, f):
+        self.f = f
+        self.prev = b""
+        self.count = 0
+        self.offsets = array("Q")
+        f.write(self.MAGIC)
+
+    def write(self, domains: list[str]) -> None:
+        parts = []
+        offset = self.f.tell()
+        for domain in domains:
+            key = "\0".join(_label_key(domain)).encode("utf-8")
+            if self.count and key <= self.prev: raise ValueError(f"Front-coded keys out of order at {domain}")
+            if self.count % self.RESTART == 0:
+                self.offsets.append(offset)
+                shared = 0
+            else:
+                shared = len(os.path.commonprefix((self.prev, key)))
+            parts.append(_varint(shared) + _varint(len(key) - shared) + key[shared:])
+            offset += len(parts[-1])
+            self.prev = key
+            self.count += 1
+        self.f.write(b"".join(parts))
+
+    def finish(self) -> None:
+        index_at = self.f.tell()
+        self.f.write(self.offsets.tobytes())
+        self.f.write(self.FOOTER.pack(self.count, index_at, self.RESTART) + self.MAGIC)
+
+def iter_front_coded(path: str):
+    with open(path, "rb") as f: data = f.read()
+    if not data.endswith(FrontCodedWriter.MAGIC): raise ValueError(f"{path} is not a front-coded blocklist")
+    count, _, _ = FrontCodedWriter.FOOTER.unpack_from(data, len(data) - FrontCodedWriter.FOOTER.size - len(FrontCodedWriter.MAGIC))
+    pos, prev = len(FrontCodedWriter.MAGIC), b""
+    for _ in range(count):
+        shared, pos = _read_varint(data, pos)
+        size, pos = _read_varint(data, pos)
+        prev = prev[:shared] + data[pos:pos + size]
+        pos += size
+        yield ".".join(prev.decode("utf-8").split("\0")[::-1])
+
+def write_artifacts(compiled_policies, formats: list[str] = None, out_dir: str = None) -> int:
+    formats = list(formats or [f.strip() for f in Config.ARTIFACT_FORMATS.split(",") if f.strip()])
+    out_dir = out_dir or Config.ARTIFACT_DIR
+    for fmt in [f for f in formats if f not in ARTIFACTS or (f == "zstd" and zstandard is None)]:
+        logger.warning(f"Skipping artifact format {fmt}: {'zstandard is not installed' if fmt == 'zstd' else 'unknown format'}")
+        formats.remove(fmt)
+    if not formats: return 0
+
+    logger.info(f"Writing aggregate blocklist artifacts: {', '.join(formats)}")
+    targets = [(f"{path}.tmp", path) for path in (os.path.join(out_dir, ARTIFACTS[fmt][0]) for fmt in formats)]
+    count = 0
+    try:
+        with contextlib.ExitStack() as stack:
+            sinks = []
+            for fmt, (tmp, _) in zip(formats, targets):
+                _, template, compression, header = ARTIFACTS[fmt]
+                f = stack.enter_context(open(tmp, "wb", buffering=1 << 20))
+                if compression == "gzip": f = stack.enter_context(gzip.GzipFile(filename="", mode="wb", fileobj=f, mtime=0))
+                elif compression == "zstd": f = stack.enter_context(zstandard.ZstdCompressor(level=10).stream_writer(f, closefd=False))
+                if template is None:
+                    writer = FrontCodedWriter(f)
+                    stack.callback(writer.finish)
+                    sinks.append(writer.write)
+                    continue
+                if header: f.write(header.encode("utf-8"))
+                prefix, suffix = template.split("{}")
+                sinks.append(lambda batch, f=f, prefix=prefix, suffix=suffix: f.write("".join(f"{prefix}{d}{suffix}" for d in batch).encode("utf-8")))
+
+            batch = []
+            for domain in merge_policy_domains(compiled_policies):
+                batch.append(domain)
+                if len(batch) == 8192:
+                    for sink in sinks: sink(batch)
+                    count += len(batch)
+                    batch = []
+            for sink in sinks: sink(batch)
+            count += len(batch)
+        for tmp, path in targets: os.replace(tmp, path)
+        logger.info(f"Successfully dumped {count:,} total consolidated entries to {', '.join(ARTIFACTS[fmt][0] for fmt in formats)}")
+    except Exception as e:
+        for tmp, _ in targets:
+            if os.path.exists(tmp): os.unlink(tmp)
+        logger.error(f"Failed writing target aggregate blocklist dump matrix: {e}")
+    return count
+
+def make_download_session() -> requests.Session:
+    session = requests.Session()
+    dl_retry = Retry(total=3, backoff_factor=1, status_forcelist=[500, 502, 503, 504])
+    session.mount("https://", HTTPAdapter(pool_connections=Config.MAX_WORKERS, pool_maxsize=Config.MAX_WORKERS + 2, max_retries=dl_retry))
+    return session
+
+def load_sources(session: requests.Session, cache: SourceCache | None, checker: RelevanceChecker | None) -> tuple[DomainTable, str] | None:
+    # Full fetch of every blocklist plus the spam TLDs. None when the primary source is unavailable.
+    table = DomainTable(BLOCKLIST_URLS)
+    with metrics.stage("fetch_sources"):
+        tld_raw_list = fetch_raw_tlds(session, cache)
+        tld_regex_expression = build_cloudflare_tld_expression(tld_raw_list)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=Config.MAX_WORKERS) as pool:
+            futures = {pool.submit(fetch_url, session, name, url, None, cache): name for name, url in BLOCKLIST_URLS.items()}
+            for future in concurrent.futures.as_completed(futures):
+                name = futures[future]
+                try:
+                    name, parsed_set, _ = future.result()
+                    table.add(name, parsed_set)
+                except Exception as e:
+                    if name == "HaGeZi Normal":
+                        logger.critical("Primary structural baseline compilation failure (HaGeZi Normal). Halting pipeline execution.", exc_info=True)
+                        return None
+                    logger.warning(f"Non-critical list source offline: {name}. Error context: {e}")
+
+    if checker:
+        logger.info(f"Checking relevance of {len(table):,} unique domains...")
+        with metrics.stage("relevance_filter"):
+            table.filter_relevance(checker, RELEVANCE_EXEMPT)
+    return table, tld_regex_expression
+
+def compile_for_sync(table: DomainTable, checker: RelevanceChecker | None) -> tuple[list, list]:
+    # Returns (policies to sync, policies for the aggregate artifacts); the latter skip collapse and quota fitting.
+    for name, kept in table.source_counts().items():
+        metrics.record_source(name, kept=kept, pruned=table.pruned_by_source.get(name, 0))
+
+    with metrics.stage("build_policies"):
+        compiled_policies = build_policy_sets(POLICIES, table)
+    for policy, domains in compiled_policies: metrics.set_gauge("policy_domains", len(domains), policy=policy["prefix"])
+    metrics.set_gauge("unique_domains", len(table))
+    metrics.set_gauge("relevance_pruned", table.pruned)
+    aggregate_policies = compiled_policies
+
+    if Config.ENABLE_SUFFIX_COLLAPSE and checker:
+        with metrics.stage("suffix_collapse"):
+            compiled_policies = apply_suffix_collapse(compiled_policies, checker.rank)
+    elif Config.ENABLE_SUFFIX_COLLAPSE:
+        logger.info("Suffix collapse needs the relevance index as its over-blocking guard. Skipping.")
+
+    with metrics.stage("fit_quota"):
+        compiled_policies, dropped = fit_to_quota(compiled_policies, checker.rank if checker else None)
+    for prefix, entries in dropped.items(): metrics.set_gauge("quota_dropped", len(entries), policy=prefix)
+    write_quota_report(dropped)
+
+    pools = build_list_pools(compiled_policies)
+    total_domains = sum(len(domains) for _, domains, _ in pools)
+    for prefix, domains, _ in pools: metrics.set_gauge("pool_domains", len(domains), pool=prefix)
+    logger.info(f"Shared list pools: {len(pools)} membership classes hold {total_domains:,} entries for {sum(len(d) for _, d in compiled_policies):,} policy memberships.")
+
+    logger.info(f"Domains pruned via Relevance Filter: {table.pruned:,}")
+    logger.info(f"Target payload footprint to sync: {total_domains:,} elements.")
+    return compiled_policies, aggregate_policies
+
+def run(args: argparse.Namespace) -> str:
     start = time.perf_counter()
     Config.validate()
-    cf = CloudflareAPI()
-    
-    active_blocklist_urls = BLOCKLIST_URLS
-    active_policies = POLICIES
-    
-    download_session = requests.Session()
-    dl_retry = Retry(total=3, backoff_factor=1, status_forcelist=[500, 502, 503, 504])
-    download_session.mount("https://", HTTPAdapter(pool_connections=Config.MAX_WORKERS, pool_maxsize=Config.MAX_WORKERS + 2, max_retries=dl_retry))
+    accounts = load_accounts()
+
+    download_session = make_download_session()
+    source_cache = SourceCache(os.path.join(Config.CACHE_DIR, "sources")) if Config.ENABLE_SOURCE_CACHE else None
 
     if Config.ENABLE_RELEVANCE_FILTER:
         checker = RelevanceChecker(download_session)
-        checker.build_dataset(max_workers=Config.MAX_WORKERS)
+        try:
+            with metrics.stage("relevance_dataset"):
+                checker.build_dataset(max_workers=Config.MAX_WORKERS)
+        except RelevanceDataError as e:
+            logger.error(f"{e}. Continuing without the relevance filter.")
+            checker = None
     else:
         logger.info("Relevance filter disabled via config. Skipping dataset build.")
         checker = None
 
-    tld_raw_list = fetch_raw_tlds(download_session)
-    tld_regex_expression = build_cloudflare_tld_expression(tld_raw_list)
+    try:
+        loaded = load_sources(download_session, source_cache, checker)
+    finally:
+        if checker: checker.close()
+    if loaded is None: return "halted"
+    table, tld_regex_expression = loaded
 
-    fetched_lists = {}
-    total_irrelevant_pruned = 0
-    
-    with concurrent.futures.ThreadPoolExecutor(max_workers=Config.MAX_WORKERS) as pool:
-        futures = {pool.submit(fetch_url, download_session, name, url, checker): name for name, url in active_blocklist_urls.items()}
-        for future in concurrent.futures.as_completed(futures):
-            name = futures[future]
-            try:
-                name, kept_set, irrelevant_count = future.result()
-                fetched_lists[name] = kept_set
-                total_irrelevant_pruned += irrelevant_count
-            except Exception as e:
-                if name == "HaGeZi Normal":
-                    logger.critical("Primary structural baseline compilation failure (HaGeZi Normal). Halting pipeline execution.", exc_info=True)
-                    return
-                logger.warning(f"Non-critical list source offline: {name}. Error context: {e}")
+    compiled_policies, aggregate_policies = compile_for_sync(table, checker)
 
-    compiled_policies = build_policy_sets(active_policies, fetched_lists)
-    total_domains = sum(len(domains) for _, domains in compiled_policies)
+    results = asyncio.run(sync_to_cloudflare(compiled_policies, tld_regex_expression, plan_only=args.plan, accounts=accounts))
+    failures = [r for r in results if isinstance(r, BaseException)]
+    if len(failures) == len(results): raise failures[0]
+    if args.plan:
+        for account, plan in zip(accounts, results):
+            if isinstance(plan, BaseException): continue
+            if account: logger.info(f"Account {account['name']}:")
+            for kind, count in plan.counts().items(): logger.info(f"  {kind:<13} {count:>5}")
+            logger.info(f"Plan only. Estimated API calls: {plan.api_calls():,}")
+        return "plan" if not failures else "partial"
 
-    if total_domains > Config.TOTAL_QUOTA:
-        logger.error(f"Total compiled payload matrix size ({total_domains:,}) exceeds infrastructure limits. Execution halted.")
-        return
+    with metrics.stage("write_aggregate"):
+        metrics.set_gauge("aggregate_domains", write_artifacts(aggregate_policies))
 
-    logger.info(f"Domains pruned via Relevance Filter: {total_irrelevant_pruned:,}")
-    logger.info(f"Target payload footprint to sync: {total_domains:,} elements.")
+    if failures:
+        logger.warning(f"Sync finished with {len(failures)} of {len(results)} accounts failing. Network timeline iteration: {time.perf_counter() - start:.2f} seconds.")
+        return "partial"
+    logger.info(f"Sync complete. Network timeline iteration: {time.perf_counter() - start:.2f} seconds.")
+    return "ok"
 
-    existing_lists = cf.get_lists()
-    existing_rules = cf.get_rules()
-
-    logger.info("Temporarily detaching lists from active firewall rules to clear dependency locks...")
-    for policy in active_policies:
-        final_rule_name = policy['policy_name']
-        existing_rule = next((r for r in existing_rules if r["name"] == final_rule_name), None)
-        if existing_rule:
-            cat_expr = policy.get("category_condition")
-            extra_restrictive_buffer = f" or {ADULT_KEYWORDS_EXPR}" if policy["prefix"] == "L_Restrictive" else ""
-            fallback_traffic = f"({cat_expr}){extra_restrictive_buffer}" if cat_expr else 'dns.domains == "detached.placeholder"'
-            payload = {
-                "name": final_rule_name,
-                "action": policy.get("action", "block"),
-                "enabled": existing_rule.get("enabled", True),
-                "filters": ["dns"],
-                "traffic": fallback_traffic
-            }
-            cond = policy.get("identity_condition")
-            if cond and "dns." not in cond:
-                payload["identity"] = cond
+# ---------------------------------------------------------------------------
+# 7. Daemon Mode & Entry Point
+# ---------------------------------------------------------------------------
+def poll_blocklist(session: requests.Session, cache: SourceCache | None, name: str) -> set[str] | None:
+    # None when every URL of the source answered 304; otherwise the source's full parse, with the
+    # unchanged URLs read back from the cache.
+    url = BLOCKLIST_URLS[name]
+    results, changed = [], False
+    for target_url in [url] if isinstance(url, str) else url:
+        domains, fresh = fetch_source(session, target_url, parse_blocklist, "blocklist-v3", cache, reuse=False, timeout=Config.REQUEST_TIMEOUT)
+        metrics.record_source(name, kind="blocklist", bytes=metrics.downloaded(target_url), not_modified=int(not fresh))
+        results.append((target_url, domains))
+        changed |= fresh
+    if not changed: return None
+
+    merged = set()
+    for target_url, domains in results:
+        if domains is None: domains, _ = fetch_source(session, target_url, parse_blocklist, "blocklist-v3", cache, timeout=Config.REQUEST_TIMEOUT)
+        merged |= domains
+    return merged
+
+def poll_tlds(session: requests.Session, cache: SourceCache | None) -> str | None:
+    tlds, fresh = fetch_source(session, SPAM_TLD_URL, parse_tld_list, "tld-v1", cache, reuse=False, timeout=Config.REQUEST_TIMEOUT)
+    return build_cloudflare_tld_expression(tlds) if fresh else None
+
+class SyncDaemon:
+    # Keeps the domain table, relevance index and remote inventory loaded, and polls every blocklist, the
+    # spam TLDs and the top lists on their own schedule. A changed source is diffed into the table and only
+    # the resulting delta reaches Cloudflare; a changed relevance index re-filters everything once.
+    def __init__(self):
+        self.session = make_download_session()
+        self.cache = SourceCache(os.path.join(Config.CACHE_DIR, "sources")) if Config.ENABLE_SOURCE_CACHE else None
+        self.checker = RelevanceChecker(self.session) if Config.ENABLE_RELEVANCE_FILTER else None
+        self.relevance_ready = False
+        self.syncers = [SyncSession(account) for account in load_accounts()]
+        self.table: DomainTable | None = None
+        self.tld_expression = ""
+        self.due: dict[str, float] = {}
+        self.stop = asyncio.Event()
+
+    @property
+    def active_checker(self) -> RelevanceChecker | None:
+        return self.checker if self.relevance_ready else None
+
+    def keys(self) -> list[str]:
+        return (["relevance"] if self.checker else []) + ["tld"] + list(BLOCKLIST_URLS)
+
+    def interval(self, key: str) -> float:
+        if key == "relevance":
+            return max(self.checker.dataset.next_check() - time.time(), Config.POLL_INTERVAL)
+        return POLL_INTERVALS.get(key, Config.POLL_INTERVAL)
+
+    def refresh_relevance(self) -> bool:
+        # True when the merged index changed, which invalidates every earlier relevance decision.
+        before = self.checker.dataset.revisions if self.relevance_ready else None
+        try:
+            with metrics.stage("relevance_dataset"):
+                self.checker.build_dataset(max_workers=Config.MAX_WORKERS)
+        except RelevanceDataError as e:
+            logger.error(f"{e}. {'Keeping the current index' if self.relevance_ready else 'Continuing without the relevance filter'}.")
+            return False
+        self.relevance_ready = True
+        if self.checker.dataset.revisions == before: return False
+        self.checker.close()   # worker processes still map the previous index file
+        return True
+
+    def reload(self) -> bool:
+        loaded = load_sources(self.session, self.cache, self.active_checker)
+        if loaded is None: return False
+        self.table, self.tld_expression = loaded
+        return True
+
+    async def poll(self, ready: list[str]) -> bool:
+        loop = asyncio.get_running_loop()
+        if "relevance" in ready and await loop.run_in_executor(None, self.refresh_relevance):
+            logger.info("Relevance index changed. Re-filtering every source...")
+            return await loop.run_in_executor(None, self.reload)
+
+        changed = False
+        if "tld" in ready:
             try:
-                cf.update_rule(existing_rule["id"], payload)
-                existing_rule["traffic"] = fallback_traffic
-                if cond and "dns." not in cond:
-                    existing_rule["identity"] = cond
+                expression = await loop.run_in_executor(None, poll_tlds, self.session, self.cache)
+                if expression is not None and expression != self.tld_expression:
+                    logger.info("Spam TLD list changed.")
+                    self.tld_expression, changed = expression, True
             except Exception as e:
-                logger.error(f"Failed to temporarily detach rule {final_rule_name}: {e}")
-
-    logger.info("Purging deprecated firewall rules to remove stale list references...")
-    valid_rule_bases = {p["policy_name"] for p in active_policies}
-    for rule in existing_rules[:]:
-        if any(kw in rule["name"] for kw in ["IoT Bypass", "Custom", "Keywords"]): continue
-        if any(target in rule["name"] for target in Config.SCRUB_TARGETS):
-            if not any(rule["name"].startswith(base) for base in valid_rule_bases):
-                try:
-                    cf.delete_rule(rule["id"])
-                    existing_rules.remove(rule)
-                    logger.info(f"Purged deprecated baseline rule: {rule['name']}")
-                except Exception as e: 
-                    logger.error(f"Failed to purge deprecated rule {rule['name']}: {e}")
-
-    expected_chunks = {}
-    for policy, optimized_domains in compiled_policies:
-        prefix = policy["prefix"]
-        needed_chunks = (len(optimized_domains) + Config.MAX_LIST_SIZE - 1) // Config.MAX_LIST_SIZE
-        expected_chunks[prefix] = max(1, needed_chunks) if optimized_domains else 0
-
-    logger.info("Executing predictive upfront cleanup of stale/excess lists to open up quota slots...")
-    for lst in existing_lists[:]:
-        if "IoT Bypass" in lst["name"]: 
-            continue
-            
-        if any(target in lst["name"] for target in Config.SCRUB_TARGETS):
-            matched_prefix = None
-            for pfx in expected_chunks:
-                if lst["name"].startswith(pfx + " "):
-                    matched_prefix = pfx
-                    break
-            
-            should_delete = False
-            if not matched_prefix:
-                should_delete = True
-            else:
-                try:
-                    idx_part = lst["name"].split()[-1]
-                    lst_idx = int(idx_part)
-                    if lst_idx > expected_chunks[matched_prefix]:
-                        should_delete = True
-                except ValueError:
-                    should_delete = True
-                    
-            if should_delete:
+                logger.warning(f"Spam TLD poll failed: {e}. Keeping the previous expression.")
+
+        names = [key for key in ready if key in BLOCKLIST_URLS]
+        results = await asyncio.gather(*(loop.run_in_executor(None, poll_blocklist, self.session, self.cache, name) for name in names), return_exceptions=True)
+        for name, domains in zip(names, results):
+            if isinstance(domains, Exception):
+                logger.warning(f"Poll of {name} failed: {domains}. Keeping the previous copy.")
+            elif domains is not None:
+                added, removed = await loop.run_in_executor(None, self.table.replace, name, domains, self.active_checker, RELEVANCE_EXEMPT)
+                logger.info(f"{name} changed upstream: +{added:,} / -{removed:,} domains")
+                changed |= bool(added or removed)
+        return changed
+
+    async def tick(self) -> str:
+        # Everything CPU-bound runs in the default executor so the API rate limiter and the poll timers keep ticking.
+        loop = asyncio.get_running_loop()
+        now = time.time()
+        if self.table is None:
+            ready = self.keys()
+            if self.checker: await loop.run_in_executor(None, self.refresh_relevance)
+            changed = await loop.run_in_executor(None, self.reload)
+        else:
+            ready = [key for key in self.keys() if self.due.get(key, 0) <= now]
+            changed = await self.poll(ready)
+        for key in ready: self.due[key] = now + self.interval(key)
+        if self.table is None: return "halted"
+        if not changed: return "idle"
+
+        compiled_policies, aggregate_policies = await loop.run_in_executor(None, compile_for_sync, self.table, self.active_checker)
+        results = await sync_accounts(self.syncers, compiled_policies, self.tld_expression)
+        with metrics.stage("write_aggregate"):
+            metrics.set_gauge("aggregate_domains", await loop.run_in_executor(None, write_artifacts, aggregate_policies))
+        failures = [r for r in results if isinstance(r, BaseException)]
+        if len(failures) == len(results): raise failures[0]
+        return "partial" if failures else "ok"
+
+    async def run(self) -> str:
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM): loop.add_signal_handler(sig, self.stop.set)
+        logger.info(f"Daemon started: polling {len(BLOCKLIST_URLS)} sources (default every {Config.POLL_INTERVAL}s).")
+        try:
+            while not self.stop.is_set():
+                metrics.reset(trace_memory=Config.TRACE_MEMORY)
+                outcome = "error"
                 try:
-                    cf.delete_list(lst["id"])
-                    existing_lists.remove(lst)
-                    logger.info(f"Pre-emptively purged out-of-bounds list slot: {lst['name']}")
+                    outcome = await self.tick()
                 except Exception as e:
-                    logger.error(f"Failed to clear space for list {lst['name']}: {e}")
-
-    all_active_list_ids, all_active_rule_names = [], []
+                    logger.error(f"Daemon cycle failed: {e}", exc_info=True)
+                if outcome != "idle":
+                    metrics.finish(outcome)
+                    metrics.export(Config.METRICS_DIR)
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self.stop.wait(), max(1.0, min(self.due.values(), default=time.time()) - time.time()))
+            logger.info("Daemon stopping.")
+            return "stopped"
+        finally:
+            for syncer in self.syncers: syncer.close()
+            if self.checker:
+                self.checker.close()
+                if self.checker.index is not None: self.checker.index.close()
 
-    for policy, optimized_domains in compiled_policies:
-        tld_expr = tld_regex_expression if policy.get("use_spam_tld", False) else ""
-        used_ids, rule_names = sync_to_cloudflare(cf, existing_lists, existing_rules, optimized_domains, policy, raw_tld_expr=tld_expr)
-        all_active_list_ids.extend(used_ids)
-        all_active_rule_names.extend(rule_names)
-
-    logger.info("Compiling absolute master aggregate blocklist payload...")
-    aggregate_master_set = set()
-    for _, domains in compiled_policies:
-        aggregate_master_set.update(domains)
-        
-    try:
-        with open("aggregate_blocklist.txt", "w", encoding="utf-8") as f:
-            for domain in sorted(list(aggregate_master_set)):
-                f.write(f"{domain}\n")
-        logger.info(f"Successfully dumped {len(aggregate_master_set):,} total consolidated entries to aggregate_blocklist.txt")
-    except Exception as e:
-        logger.error(f"Failed writing target aggregate blocklist dump matrix: {e}")
+async def run_daemon() -> str:
+    Config.validate()
+    return await SyncDaemon().run()
 
-    cleanup_orphans(cf, existing_lists, existing_rules, all_active_list_ids, all_active_rule_names)
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="Compile blocklists and sync them to Cloudflare Gateway lists and rules.")
+    parser.add_argument("--plan", action="store_true", help="print the Cloudflare operations a sync would perform and exit without writing")
+    parser.add_argument("--daemon", action="store_true", help="keep running, poll each source on its own interval and push changes as they appear")
+    args = parser.parse_args(argv)
+    if args.plan and args.daemon: parser.error("--plan cannot be combined with --daemon")
+    if args.daemon:
+        asyncio.run(run_daemon())
+        return
 
-    logger.info(f"Sync complete. Network timeline iteration: {time.perf_counter() - start:.2f} seconds.")
+    metrics.reset(trace_memory=Config.TRACE_MEMORY)
+    outcome = "error"
+    try:
+        outcome = run(args)
+    finally:
+        metrics.finish(outcome)
+        metrics.export(Config.METRICS_DIR)
 
 if __name__ == "__main__":
     main()